@@ -0,0 +1,216 @@
+"""
+Приближенный поиск ближайших соседей (IVF) на чистом numpy.
+
+Векторы разбиваются сферическим k-means на n_lists кластеров; строки хранилища
+переупорядочиваются по кластерам, поэтому каждый список — непрерывный срез
+mmap-матрицы. Запрос сравнивается с центроидами и затем только со строками
+n_probe ближайших списков.
+
+Бенчмарк recall@k и задержки против точного поиска:
+    python ann_index.py --benchmark [--size 100000] [--dims 1536]
+    python ann_index.py --benchmark --store vector_database.json
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+ANN_FORMAT_VERSION = 1
+DEFAULT_PROBES = 32
+
+
+def default_n_lists(count):
+    """~4·√N списков: в каждом в среднем √N/4 векторов."""
+    return max(1, int(round(4 * np.sqrt(count))))
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def assign_lists(matrix, centroids, block_size=8192):
+    """Номер ближайшего центроида для каждой строки (блоками, чтобы не держать N×L в памяти)."""
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), block_size):
+        block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+        assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_ivf(matrix, n_lists=None, iterations=10, sample_size=None, seed=0):
+    """Сферический k-means на выборке строк. Возвращает центроиды (n_lists × d, нормированные)."""
+    rng = np.random.default_rng(seed)
+    n_lists = min(n_lists or default_n_lists(len(matrix)), len(matrix))
+    sample_size = min(len(matrix), sample_size or 64 * n_lists)
+    sample = np.asarray(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        empty = np.bincount(assignments, minlength=n_lists) == 0
+        # Пустые кластеры переинициализируются случайными точками выборки
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+        centroids = _normalize(sums).astype(np.float32)
+    return centroids
+
+
+def build_ivf(matrix, n_lists=None, iterations=10, seed=0):
+    """
+    Строит IVF-разметку: (order, centroids, offsets).
+    order — перестановка строк, после которой список l занимает строки offsets[l]:offsets[l + 1].
+    """
+    centroids = train_ivf(matrix, n_lists, iterations, seed=seed)
+    assignments = assign_lists(matrix, centroids)
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+    return order, centroids, offsets
+
+
+def save_ivf(file, centroids, offsets):
+    """file — путь или открытый бинарный файл."""
+    np.savez(file, version=ANN_FORMAT_VERSION, centroids=centroids.astype(np.float32), offsets=offsets)
+
+
+def load_ivf(path, count, dimensions, n_probe=DEFAULT_PROBES):
+    """Загружает IVF-разметку и проверяет, что она соответствует матрице хранилища."""
+    with np.load(path) as data:
+        if int(data["version"]) != ANN_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия ANN-индекса {path}: {int(data['version'])}")
+        centroids, offsets = data["centroids"], data["offsets"]
+    if int(offsets[-1]) != count or centroids.shape[1] != dimensions:
+        raise ValueError(f"ANN-индекс {path} не соответствует хранилищу")
+    return IVFBackend(centroids, offsets, n_probe)
+
+
+class IVFBackend:
+    """IVF-поиск по матрице, строки которой упорядочены по спискам (см. build_ivf)."""
+
+    name = "ivf"
+
+    def __init__(self, centroids, offsets, n_probe=DEFAULT_PROBES):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.n_probe = max(1, min(n_probe, len(self.centroids)))
+
+    def top_k_indices(self, matrix, query, top_k):
+        """query — нормированный float32-вектор. Возвращает (индексы, близости) по убыванию."""
+        centroid_sims = self.centroids @ query
+        n_probe = self.n_probe
+        probes = np.argpartition(-centroid_sims, n_probe - 1)[:n_probe] if n_probe < len(centroid_sims) \
+            else np.arange(len(centroid_sims))
+
+        ranges = [(self.offsets[l], self.offsets[l + 1]) for l in probes if self.offsets[l + 1] > self.offsets[l]]
+        if not ranges:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.float32)
+        indices = np.concatenate([np.arange(start, end) for start, end in ranges])
+        sims = np.concatenate([matrix[start:end] @ query for start, end in ranges])
+
+        top_k = min(top_k, len(sims))
+        best = np.argpartition(-sims, top_k - 1)[:top_k] if top_k < len(sims) else np.arange(len(sims))
+        best = best[np.argsort(-sims[best], kind="stable")]
+        return indices[best], sims[best]
+
+    def status(self):
+        sizes = np.diff(self.offsets)
+        return {"type": self.name, "lists": len(self.centroids), "n_probe": self.n_probe,
+                "max_list_size": int(sizes.max()) if len(sizes) else 0}
+
+
+# --- БЕНЧМАРК ---
+
+def synthetic_vectors(count, dimensions, clusters=5000, noise=1.0, seed=0):
+    """Кластеризованные нормированные векторы — грубая модель эмбеддингов текстов."""
+    rng = np.random.default_rng(seed)
+    centers = _normalize(rng.standard_normal((clusters, dimensions)).astype(np.float32))
+    labels = rng.integers(0, clusters, count)
+    matrix = np.empty((count, dimensions), dtype=np.float32)
+    for start in range(0, count, 10000):
+        part = labels[start:start + 10000]
+        block = centers[part] + noise / np.sqrt(dimensions) * rng.standard_normal((len(part), dimensions))
+        matrix[start:start + 10000] = _normalize(block)
+    return matrix
+
+
+def _exact_top_k(matrix, query, top_k):
+    sims = matrix @ query
+    best = np.argpartition(-sims, top_k - 1)[:top_k]
+    return best[np.argsort(-sims[best])]
+
+
+def latency_percentiles(timings):
+    """p50 и p95 в миллисекундах по списку длительностей в секундах."""
+    timings = np.array(timings) * 1000
+    return float(np.percentile(timings, 50)), float(np.percentile(timings, 95))
+
+
+def benchmark(matrix, queries, top_k=10, n_lists=None, probes=(1, 4, 8, 16, 32, 64)):
+    """Печатает recall@k и задержку (p50/p95) IVF при разных n_probe относительно точного поиска."""
+    started = time.perf_counter()
+    order, centroids, offsets = build_ivf(matrix, n_lists)
+    ordered = np.ascontiguousarray(matrix[order])
+    print(f"🏗️  IVF: {len(centroids)} списков, построение {time.perf_counter() - started:.1f} с")
+
+    exact, timings = [], []
+    for query in queries:
+        started = time.perf_counter()
+        exact.append(set(_exact_top_k(ordered, query, top_k).tolist()))
+        timings.append(time.perf_counter() - started)
+    p50, p95 = latency_percentiles(timings)
+    print(f"\n{'режим':>12} | {'recall@' + str(top_k):>10} | {'p50, мс':>8} | {'p95, мс':>8}")
+    print(f"{'точный':>12} | {1.0:>10.3f} | {p50:>8.2f} | {p95:>8.2f}")
+
+    for n_probe in probes:
+        backend = IVFBackend(centroids, offsets, n_probe)
+        hits, timings = 0, []
+        for query, truth in zip(queries, exact):
+            started = time.perf_counter()
+            found, _ = backend.top_k_indices(ordered, query, top_k)
+            timings.append(time.perf_counter() - started)
+            hits += len(truth.intersection(found.tolist()))
+        p50, p95 = latency_percentiles(timings)
+        print(f"{'n_probe=' + str(n_probe):>12} | {hits / (len(queries) * top_k):>10.3f} | {p50:>8.2f} | {p95:>8.2f}")
+
+
+def benchmark_data(store=None, size=100000, dims=1536, queries=200):
+    """(матрица, запросы) для бенчмарков: векторы готовой базы или синтетика."""
+    rng = np.random.default_rng(1)
+    if store:
+        from vector_index import load_vector_records
+        matrix, _ = load_vector_records(store, mmap=False)
+        matrix = _normalize(np.asarray(matrix, dtype=np.float32))
+        # Запросы — зашумленные векторы базы: близкие, но не совпадающие с чанками
+        picked = matrix[rng.integers(0, len(matrix), queries)]
+        noise = 0.3 / np.sqrt(matrix.shape[1]) * rng.standard_normal(picked.shape)
+        return matrix, _normalize(picked + noise).astype(np.float32)
+    print(f"🎲 Синтетическая база: {size} × {dims}")
+    matrix = synthetic_vectors(size + queries, dims)
+    return matrix[:size], matrix[size:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IVF-индекс: бенчмарк recall@k и задержки")
+    parser.add_argument("--benchmark", action="store_true", help="Сравнить IVF с точным поиском")
+    parser.add_argument("--store", help="Векторная база (vector_database*.json с .npy-хранилищем) вместо синтетики")
+    parser.add_argument("--size", type=int, default=100000, help="Размер синтетической базы")
+    parser.add_argument("--dims", type=int, default=1536, help="Размерность синтетических векторов")
+    parser.add_argument("--queries", type=int, default=200, help="Количество запросов")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--lists", type=int, help="Количество списков IVF (по умолчанию ~4·√N)")
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        parser.print_help()
+        return
+
+    matrix, queries = benchmark_data(args.store, args.size, args.dims, args.queries)
+    benchmark(matrix, queries, min(args.top_k, len(matrix)), args.lists)
+
+
+if __name__ == "__main__":
+    main()
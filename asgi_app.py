@@ -0,0 +1,357 @@
+"""
+Асинхронный (ASGI) режим сервера.
+
+/chat, /chat/stream, /transcribe и чтения /api/* обслуживаются асинхронными
+обработчиками (AsyncOpenAI + PyMongo Async), остальные маршруты (страницы,
+регистрация, запись данных) проксируются в обычное Flask-приложение из main.py.
+
+Запуск: uvicorn asgi_app:application --host 0.0.0.0 --port 5000 --workers 2
+"""
+
+import asyncio
+
+import certifi
+from asgiref.wsgi import WsgiToAsgi
+from bson import ObjectId
+from bson.json_util import dumps
+from datetime import datetime
+from openai import AsyncOpenAI
+from pymongo import AsyncMongoClient
+from quart import Quart, Response, request, session, jsonify
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+
+import main as core
+from clients import (HttpPoolMetrics, MongoPoolMetrics, mongo_client_options, openai_client_settings,
+                     register_pool_metrics)
+from embeddings import embedding_id, embedding_request_kwargs
+from openai_http import openai_client_kwargs
+
+app = Quart(__name__, static_folder=None)
+app.config['SECRET_KEY'] = core.app.config['SECRET_KEY']
+
+async_openai_metrics = register_pool_metrics("openai_async", HttpPoolMetrics())
+async_mongo_metrics = register_pool_metrics("mongo_async", MongoPoolMetrics())
+async_openai_client = None
+async_mongo_client = None
+adb = None
+
+
+@app.before_serving
+async def startup():
+    global async_openai_client, async_mongo_client, adb
+    core.startup()
+    async_openai_client = AsyncOpenAI(
+        api_key=core.require_env("OPENAI_API_KEY"),
+        **openai_client_kwargs(openai_client_settings(), async_openai_metrics, asynchronous=True)
+    )
+    async_mongo_client = AsyncMongoClient(core.require_env("MONGO_URI"), tlsCAFile=certifi.where(),
+                                          **mongo_client_options(async_mongo_metrics))
+    adb = async_mongo_client[core.DB_NAME]
+    print("✓ Асинхронный режим (ASGI) готов к работе")
+
+
+@app.after_serving
+async def shutdown():
+    if async_mongo_client is not None:
+        await async_mongo_client.close()
+    if async_openai_client is not None:
+        await async_openai_client.close()
+
+
+# --- RAG-ПАЙПЛАЙН ---
+
+async def get_embedding_async(text, embedding=core.EMBEDDING):
+    # Кэш эмбеддингов может читать SQLite — блокирующие вызовы уходят в поток, не в цикл событий
+    key = embedding_id(embedding)
+    vector = await asyncio.to_thread(core.embedding_cache.lookup, text, key)
+    if vector is not None:
+        return vector
+    response = await async_openai_client.embeddings.create(input=[text], **embedding_request_kwargs(embedding))
+    return await asyncio.to_thread(core.embedding_cache.store_vector, text, key, response.data[0].embedding)
+
+
+async def analyze_spending_habits_async(user_id: str, days: int = 30) -> dict:
+    try:
+        print(f"📊 Начало анализа для пользователя: {user_id}")
+        coverage = await adb[core.SPENDING_COVERAGE_COLLECTION].find_one(core.spending_coverage_query(user_id))
+        if core.aggregates_cover(coverage, days):
+            daily_docs = await adb[core.SPENDING_COLLECTION].find(core.daily_spending_query(user_id, days)).to_list(None)
+            return core.summarize_totals(*core.daily_totals(daily_docs))
+
+        cursor = await adb.transactions.aggregate(core.spending_pipeline(user_id, days))
+        return core.summarize_spending(await cursor.to_list(None))
+    except Exception as e:
+        print(f"❌ Ошибка в analyze_spending_habits_async: {e}")
+        return None
+
+
+async def run_stage(name: str, awaitable, default):
+    """Асинхронный аналог core.collect_stage: таймаут этапа и деградация до значения по умолчанию."""
+    try:
+        return await asyncio.wait_for(awaitable, timeout=core.RAG_STAGE_TIMEOUTS[name])
+    except asyncio.TimeoutError:
+        print(f"⏱️ Этап '{name}' превысил таймаут {core.RAG_STAGE_TIMEOUTS[name]}с, используется значение по умолчанию")
+    except Exception as e:
+        print(f"⚠️ Ошибка на этапе '{name}': {e}")
+    return default
+
+
+async def prepare_rag_request_async(user_id: str, message: str, lang: str) -> dict:
+    """Асинхронный аналог core.prepare_rag_request: общие шаги берутся из main.py, здесь только ввод-вывод."""
+    plan = core.plan_rag_request(user_id, message, lang)
+
+    user_oid = ObjectId(user_id)
+    user_context = await asyncio.to_thread(core.cached_user_context, user_id)
+    stages = {
+        "chat_history": run_stage(
+            "chat_history",
+            adb.chat_history.find({"userId": user_oid}).sort("timestamp", -1).limit(3).to_list(None),
+            []
+        ),
+    }
+    if plan["needs_embedding"]:
+        stages["embedding"] = run_stage("embedding", get_embedding_async(message), None)
+    if user_context is None:
+        stages["user"] = run_stage("user", adb.users.find_one({"_id": user_oid}, core.USER_CONTEXT_FIELDS), None)
+        stages["accounts"] = run_stage("accounts", adb.accounts.find({"userId": user_oid}).to_list(None), None)
+        stages["goals"] = run_stage("goals", adb.goals.find({"userId": user_oid}).to_list(None), None)
+    if plan["wants_analytics"]:
+        stages["analytics"] = run_stage("analytics", analyze_spending_habits_async(user_id), None)
+    tasks = {name: asyncio.create_task(coro) for name, coro in stages.items()}
+
+    question_vector = await tasks["embedding"] if "embedding" in tasks else None
+    chunks_with_sources, rag_request = core.retrieve_rag_context(user_id, message, plan, question_vector)
+    if rag_request is not None:
+        for task in tasks.values():
+            task.cancel()
+        return rag_request
+
+    results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+    if user_context is None:
+        user_context = await asyncio.to_thread(
+            core.remember_user_context, user_id, results["user"], results["accounts"], results["goals"]
+        )
+    return core.personal_rag_request(user_id, message, plan, chunks_with_sources, question_vector,
+                                     user_context, results.get("analytics"), results["chat_history"])
+
+
+async def save_chat_exchange_async(user_id: str, message: str, bot_reply: str):
+    await adb.chat_history.insert_many([
+        {"userId": ObjectId(user_id), "role": "user", "message": message, "timestamp": datetime.utcnow()},
+        {"userId": ObjectId(user_id), "role": "assistant", "message": bot_reply, "timestamp": datetime.utcnow()},
+    ])
+
+
+async def finish_rag_response_async(user_id: str, message: str, rag_request: dict, bot_reply: str) -> dict:
+    core.cache_rag_reply(rag_request, bot_reply)
+
+    await save_chat_exchange_async(user_id, message, bot_reply)
+    return core.build_rag_result(bot_reply, rag_request["should_open_bank_site"])
+
+
+async def get_rag_response_async(user_id: str, message: str) -> dict:
+    lang = 'ru'
+
+    try:
+        lang = core.resolve_language(message)
+        rag_request = await prepare_rag_request_async(user_id, message, lang)
+
+        if rag_request["cached_reply"] is not None:
+            return await finish_rag_response_async(user_id, message, rag_request, rag_request["cached_reply"])
+
+        response = await async_openai_client.chat.completions.create(**core.rag_completion_kwargs(rag_request))
+        bot_reply = core.clean_reply_text(response.choices[0].message.content)
+
+        return await finish_rag_response_async(user_id, message, rag_request, bot_reply)
+
+    except Exception as e:
+        print(f"✗ Ошибка в get_rag_response_async: {e}")
+        return core.rag_error_result(lang)
+
+
+async def stream_rag_response_async(user_id: str, message: str):
+    lang = 'ru'
+
+    try:
+        lang = core.resolve_language(message)
+        rag_request = await prepare_rag_request_async(user_id, message, lang)
+        yield core.rag_meta_event(rag_request)
+
+        if rag_request["cached_reply"] is not None:
+            bot_reply = rag_request["cached_reply"]
+            yield core.sse_event("token", {"text": bot_reply})
+        else:
+            stream = await async_openai_client.chat.completions.create(
+                **core.rag_completion_kwargs(rag_request, stream=True)
+            )
+            reply_parts = []
+            async for chunk in stream:
+                text = core.stream_chunk_text(chunk)
+                if text:
+                    reply_parts.append(text)
+                    yield core.sse_event("token", {"text": text})
+            bot_reply = "".join(reply_parts)
+
+        yield core.sse_event("done", await finish_rag_response_async(user_id, message, rag_request, bot_reply))
+
+    except Exception as e:
+        print(f"✗ Ошибка в stream_rag_response_async: {e}")
+        yield core.sse_event("error", core.rag_error_result(lang))
+
+
+# --- МАРШРУТЫ ---
+
+def json_response(documents):
+    return Response(dumps(documents), status=200, content_type='application/json')
+
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = await request.get_json()
+    user_message = data.get("message", "")
+    if not user_message:
+        return jsonify({
+            "reply": "Пожалуйста, напишите что-нибудь.",
+            "open_bank_site": False,
+            "bank_url": None
+        })
+
+    return jsonify(await get_rag_response_async(session['user_id'], user_message))
+
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    data = await request.get_json()
+    user_message = data.get("message", "")
+    if not user_message:
+        return jsonify({
+            "reply": "Пожалуйста, напишите что-нибудь.",
+            "open_bank_site": False,
+            "bank_url": None
+        })
+
+    response = Response(
+        stream_rag_response_async(session['user_id'], user_message),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.timeout = None
+    return response
+
+
+@app.route('/transcribe', methods=['POST'])
+async def transcribe_audio():
+    files = await request.files
+    if 'audio' not in files:
+        return jsonify({"error": "Аудиофайл не найден"}), 400
+
+    audio_file = files['audio']
+    try:
+        # Файл передается из памяти — без общего временного файла на диске
+        transcript = await async_openai_client.audio.transcriptions.create(
+            model="whisper-1",
+            file=(audio_file.filename or "recording.webm", audio_file.read())
+        )
+        return jsonify({'transcribed_text': transcript.text})
+    except Exception as e:
+        print(f"Ошибка при распознавании речи: {e}")
+        return jsonify({"error": "Не удалось распознать речь"}), 500
+
+
+@app.route('/api/transactions', methods=['GET'])
+async def get_transactions():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        limit = core.page_limit(request.args.get('limit', type=int))
+        query = core.transactions_page_query(
+            session['user_id'], request.args.get('period', 'month'), request.args.get('before')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        cursor = adb.transactions.find(query, core.TRANSACTION_FIELDS).sort(core.TRANSACTIONS_SORT).limit(limit)
+        page = await cursor.to_list(None)
+        return Response(core.stream_json_array(page), status=200, content_type='application/json',
+                        headers=core.next_cursor_headers(page, limit))
+    except Exception as e:
+        print(f"Ошибка получения транзакций: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/analytics', methods=['GET'])
+async def get_analytics():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        user_id = session['user_id']
+        analysis, user_goals = await asyncio.gather(
+            analyze_spending_habits_async(user_id, core.PERIOD_DAYS.get(request.args.get('period'), 30)),
+            adb.goals.find({"userId": ObjectId(user_id)}).to_list(None)
+        )
+        if not analysis:
+            return jsonify({"error": "Недостаточно данных для анализа"}), 400
+
+        return jsonify({
+            "analysis": {
+                "total_expenses": analysis['total_expenses'],
+                "categories": analysis['categories'],
+                "top_category": analysis['top_category'],
+                "night_spending_percentage": analysis['night_spending_percentage']
+            },
+            "recommendations": core.generate_personalized_recommendations(user_id, analysis, user_goals)
+        }), 200
+    except Exception as e:
+        print(f"❌ Критическая ошибка в /api/analytics: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/accounts')
+async def get_accounts():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        user_accounts = await adb.accounts.find({"userId": ObjectId(session['user_id'])}).to_list(None)
+        return json_response(user_accounts)
+    except Exception as e:
+        print(f"❌ Ошибка при получении счетов: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/api/goals', methods=['GET'])
+async def get_goals():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    try:
+        user_goals = await adb.goals.find({"userId": ObjectId(session['user_id'])}).to_list(None)
+        return json_response(user_goals)
+    except Exception as e:
+        print(f"❌ Ошибка при получении целей: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# --- ДИСПЕТЧЕР ---
+
+flask_asgi_app = WsgiToAsgi(core.app)
+_async_routes = app.url_map.bind("localhost")
+
+
+async def application(scope, receive, send):
+    """Асинхронные маршруты обслуживает Quart, остальные — Flask-приложение из main.py."""
+    if scope["type"] == "http":
+        try:
+            _async_routes.match(scope["path"], method=scope["method"])
+        except (NotFound, MethodNotAllowed):
+            return await flask_asgi_app(scope, receive, send)
+    return await app(scope, receive, send)
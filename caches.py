@@ -0,0 +1,430 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+from bson import json_util
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " \t\n.,!?;:…\"'«»()"
+
+
+def normalize_cache_text(text):
+    """Нормализует текст вопроса для ключа кэша: регистр, пробелы, пунктуация по краям."""
+    text = _WHITESPACE_RE.sub(" ", (text or "").lower().replace("ё", "е"))
+    return text.strip(_EDGE_PUNCTUATION)
+
+
+class LRUCache:
+    """Потокобезопасный in-process LRU-кэш с TTL."""
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, stored_at = item
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.time())
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteStore(ABC):
+    """SQLite-хранилище, общее для воркеров: соединение на поток, заново в каждом процессе (как LazyClient)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_pid = None
+        self._schema_lock = threading.Lock()
+        self._writes = 0
+
+    def _connection(self):
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, pid
+        if self._schema_pid != pid:
+            with self._schema_lock:
+                if self._schema_pid != pid:
+                    self._create_schema(conn)
+                    self._schema_pid = pid
+        return conn
+
+    @abstractmethod
+    def _create_schema(self, conn):
+        """Создает таблицы хранилища (CREATE ... IF NOT EXISTS) на первом соединении процесса."""
+
+
+class SQLiteEmbeddingStore(SQLiteStore):
+    """
+    Персистентное хранилище эмбеддингов в локальном SQLite-файле, общем для воркеров.
+    Время обращения копится в памяти и пишется перед вытеснением.
+    """
+
+    MAX_PENDING_TOUCHES = 4096
+
+    def __init__(self, path, max_size=50000, ttl=None):
+        super().__init__(path)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+
+    def _create_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY, vector BLOB NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_accessed ON embeddings (accessed_at)")
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute("SELECT vector, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if self.ttl is not None and now - row[1] > self.ttl:
+            # Просроченную запись удалит _evict
+            return None
+        with self._touched_lock:
+            if key in self._touched or len(self._touched) < self.MAX_PENDING_TOUCHES:
+                self._touched[key] = now
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def set(self, key, vector):
+        now = time.time()
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO embeddings (key, vector, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, np.asarray(vector, dtype=np.float32).tobytes(), now, now)
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._flush_touches(conn)
+            self._evict(conn)
+
+    def _flush_touches(self, conn):
+        with self._touched_lock:
+            touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                             [(accessed_at, key) for key, accessed_at in touched.items()])
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn):
+        if self.ttl is not None:
+            conn.execute("DELETE FROM embeddings WHERE created_at < ?", (time.time() - self.ttl,))
+        conn.execute(
+            "DELETE FROM embeddings WHERE key IN ("
+            " SELECT key FROM embeddings ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+
+
+class EmbeddingCache:
+    """
+    Кэш эмбеддингов по нормализованному тексту вопроса.
+    Первый уровень — LRU в памяти процесса, второй (опционально) — SQLite-файл,
+    общий для воркеров. Ведет счетчики попаданий и промахов.
+    """
+
+    def __init__(self, max_size=2048, ttl=7 * 24 * 3600, sqlite_path=None, sqlite_max_size=50000):
+        self.memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.store = SQLiteEmbeddingStore(sqlite_path, sqlite_max_size, ttl) if sqlite_path else None
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+
+    @staticmethod
+    def make_key(text, model):
+        normalized = normalize_cache_text(text)
+        return hashlib.sha256(f"{model}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def lookup(self, text, model):
+        """Ищет эмбеддинг в кэше; обновляет счетчики. Возвращает None при промахе."""
+        key = self.make_key(text, model)
+
+        vector = self.memory.get(key)
+        if vector is not None:
+            self._count(hit=True)
+            return vector
+
+        if self.store is not None:
+            try:
+                vector = self.store.get(key)
+            except sqlite3.Error as e:
+                print(f"⚠️ Ошибка чтения кэша эмбеддингов: {e}")
+                vector = None
+            if vector is not None:
+                self._count(hit=True, persistent=True)
+                self.memory.set(key, vector)
+                return vector
+
+        self._count(hit=False)
+        return None
+
+    def _count(self, hit, persistent=False):
+        # lookup вызывается из потоков rag_executor; счетчики меняются под блокировкой LRU
+        with self.memory._lock:
+            if hit:
+                self.hits += 1
+                self.persistent_hits += persistent
+            else:
+                self.misses += 1
+
+    def store_vector(self, text, model, vector):
+        """Кладет свежевычисленный эмбеддинг в кэш и возвращает его read-only копию."""
+        key = self.make_key(text, model)
+        vector = np.array(vector, dtype=np.float32)
+        vector.setflags(write=False)
+        self.memory.set(key, vector)
+        if self.store is not None:
+            try:
+                self.store.set(key, vector)
+            except sqlite3.Error as e:
+                print(f"⚠️ Ошибка записи кэша эмбеддингов: {e}")
+        return vector
+
+    def get_or_compute(self, text, model, compute_fn):
+        """Возвращает эмбеддинг из кэша или вычисляет его через compute_fn(text)."""
+        vector = self.lookup(text, model)
+        if vector is not None:
+            return vector
+        return self.store_vector(text, model, compute_fn(text))
+
+    def stats(self):
+        with self.memory._lock:
+            hits, misses, persistent_hits = self.hits, self.misses, self.persistent_hits
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "persistent_hits": persistent_hits,
+            "hit_rate": hits / total if total else 0.0,
+            "memory_size": len(self.memory),
+            "persistent": self.store is not None,
+        }
+
+
+def embedding_cache_from_env():
+    """Создает EmbeddingCache по переменным окружения EMBEDDING_CACHE_*."""
+    return EmbeddingCache(
+        max_size=int(os.getenv("EMBEDDING_CACHE_SIZE", 2048)),
+        ttl=int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 3600)),
+        sqlite_path=os.getenv("EMBEDDING_CACHE_DB") or None,
+        sqlite_max_size=int(os.getenv("EMBEDDING_CACHE_DB_SIZE", 50000)),
+    )
+
+
+class SemanticResponseCache:
+    """
+    Кэш ответов RAG для вопросов «по базе знаний».
+    Ключ — (язык, найденные чанки, флаги промпта); внутри ключа ответ
+    переиспользуется, если эмбеддинг нового вопроса ближе порога к сохраненному.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries_per_key=32, max_keys=1024):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries_per_key = max_entries_per_key
+        self._buckets = LRUCache(max_size=max_keys, ttl=None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(lang, chunk_contents, *flags):
+        digest = hashlib.sha256()
+        for content in chunk_contents:
+            digest.update(hashlib.sha256(content.encode("utf-8")).digest())
+        return (lang, digest.hexdigest()) + tuple(flags)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, key, question_vector):
+        query = self._normalize(question_vector)
+        now = time.time()
+        with self._lock:
+            entries = self._buckets.get(key) or []
+            entries = [e for e in entries if now - e[2] <= self.ttl and e[0].shape == query.shape]
+            if entries:
+                self._buckets.set(key, entries)
+                similarities = np.stack([e[0] for e in entries]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.hits += 1
+                    return entries[best][1]
+            self.misses += 1
+            return None
+
+    def set(self, key, question_vector, reply):
+        with self._lock:
+            entries = list(self._buckets.get(key) or [])
+            entries.append((self._normalize(question_vector), reply, time.time()))
+            self._buckets.set(key, entries[-self.max_entries_per_key:])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "keys": len(self._buckets),
+        }
+
+
+def response_cache_from_env():
+    """Создает SemanticResponseCache, если он включен через RESPONSE_CACHE_ENABLED=1."""
+    if os.getenv("RESPONSE_CACHE_ENABLED", "0").lower() not in ("1", "true", "yes"):
+        return None
+    return SemanticResponseCache(
+        threshold=float(os.getenv("RESPONSE_CACHE_THRESHOLD", 0.95)),
+        ttl=int(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+    )
+
+
+class SQLiteContextStore(SQLiteStore):
+    """
+    Общий для воркеров бэкенд UserContextCache: документы Mongo хранятся
+    в SQLite-файле в виде Extended JSON.
+    """
+
+    def __init__(self, path, ttl=60):
+        super().__init__(path)
+        self.ttl = ttl
+
+    def _create_schema(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_context ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        # Просроченные записи прежних запусков не должны лежать в файле до ближайшей очистки
+        conn.execute("DELETE FROM user_context WHERE created_at < ?", (time.time() - self.ttl,))
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, created_at FROM user_context WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json_util.loads(row[0])
+
+    def set(self, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO user_context (key, value, created_at) VALUES (?, ?, ?)",
+            (key, json_util.dumps(value), time.time())
+        )
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._connection().execute("DELETE FROM user_context WHERE created_at < ?", (time.time() - self.ttl,))
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM user_context WHERE key = ?", (key,))
+
+
+class UserContextCache:
+    """
+    Кэш профиля клиента для чата: {"user", "accounts", "goals"} по userId.
+    Короткий TTL плюс явная инвалидация из эндпоинтов записи. Бэкенд — любой объект
+    с get/set/delete: по умолчанию LRUCache процесса, SQLiteContextStore — общий для воркеров.
+    """
+
+    def __init__(self, ttl=60, max_size=4096, backend=None):
+        self.backend = backend if backend is not None else LRUCache(max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        try:
+            context = self.backend.get(str(user_id))
+        except sqlite3.Error as e:
+            print(f"⚠️ Ошибка чтения кэша профиля: {e}")
+            context = None
+        if context is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return context
+
+    def set(self, user_id, context):
+        try:
+            self.backend.set(str(user_id), context)
+        except sqlite3.Error as e:
+            print(f"⚠️ Ошибка записи кэша профиля: {e}")
+
+    def invalidate(self, user_id):
+        try:
+            self.backend.delete(str(user_id))
+        except sqlite3.Error as e:
+            print(f"⚠️ Ошибка инвалидации кэша профиля: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "backend": type(self.backend).__name__,
+        }
+
+
+def user_context_cache_from_env():
+    """
+    Создает UserContextCache по USER_CONTEXT_CACHE_*; USER_CONTEXT_CACHE_TTL=0 отключает кэш.
+    При заданном USER_CONTEXT_CACHE_DB кэш и инвалидация общие для всех воркеров машины.
+    """
+    ttl = int(os.getenv("USER_CONTEXT_CACHE_TTL", 60))
+    if ttl <= 0:
+        return None
+    sqlite_path = os.getenv("USER_CONTEXT_CACHE_DB")
+    return UserContextCache(
+        ttl=ttl,
+        max_size=int(os.getenv("USER_CONTEXT_CACHE_SIZE", 4096)),
+        backend=SQLiteContextStore(sqlite_path, ttl) if sqlite_path else None,
+    )
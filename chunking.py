@@ -0,0 +1,204 @@
+"""
+Структурный чанкер базы знаний и удаление почти одинаковых чанков.
+
+Текст сначала делится на смысловые единицы: пары «Вопрос: … Ответ: …»
+(«Сұрақ: … Жауап: …»), markdown-разделы и абзацы. Пары вопрос-ответ не
+режутся и не склеиваются друг с другом; короткие абзацы упаковываются в чанк
+до chunk_size символов. Сплошной текст (страницы сайта) режется по границам
+предложений с перекрытием целыми предложениями, а не по фиксированным
+смещениям посреди слова.
+
+Модуль не имеет побочных эффектов при импорте — его функции выполняются
+в процессах ProcessPoolExecutor.
+"""
+
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+# Входит в хэш чанка: смена алгоритма означает новые чанки и новые векторы
+CHUNKER_VERSION = "structure-v1"
+
+QA_START_RE = re.compile(r"(?=(?:Вопрос|Сұрақ)\s*:)")
+ANSWER_RE = re.compile(r"(?:Ответ|Жауап)\s*:")
+PARAGRAPH_RE = re.compile(r"\n\s*\n|\n(?=#{1,6}\s)")
+# Конец предложения: знак препинания и пробел либо сразу заглавная буква
+# (на страницах сайта предложения часто склеены: «договора.Наценка»)
+SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+|(?<=[.!?…])(?=[A-ZА-ЯЁӘҒҚҢӨҰҮҺІ])")
+WORD_RE = re.compile(r"\w+")
+
+# Пара вопрос-ответ длиннее QA_MAX_FACTOR * chunk_size все же делится — с вопросом в каждой части
+QA_MAX_FACTOR = 2
+PARALLEL_MIN_SOURCES = 32
+
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+DEDUPE_THRESHOLD = 0.9
+_MERSENNE_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(20240601)
+_MINHASH_A = _rng.integers(1, _MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.int64)
+_MINHASH_B = _rng.integers(0, _MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.int64)
+
+
+def _clean(text):
+    return re.sub(r"[ \t\u00a0\u2028\u202f]+", " ", text).strip()
+
+
+def split_units(text):
+    """
+    Смысловые единицы текста: [(текст, это_пара_вопрос_ответ)].
+    Текст до первого «Вопрос:» и текст без пар делятся на абзацы и разделы.
+    """
+    units = []
+    for part in QA_START_RE.split(text):
+        part = _clean(part)
+        if not part:
+            continue
+        if QA_START_RE.match(part):
+            units.append((part, True))
+            continue
+        units.extend((_clean(paragraph), False) for paragraph in PARAGRAPH_RE.split(part) if paragraph.strip())
+    return units
+
+
+def _split_words(text, limit):
+    """Последний рубеж для «предложений» без знаков препинания: резка по словам."""
+    pieces, current = [], ""
+    for word in text.split(" "):
+        if current and len(current) + 1 + len(word) > limit:
+            pieces.append(current)
+            current = ""
+        # Слово длиннее лимита (URL, таблица без пробелов) режется как есть
+        while len(word) > limit:
+            pieces.append(word[:limit])
+            word = word[limit:]
+        current = f"{current} {word}" if current else word
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_sentences(text, limit):
+    sentences = []
+    for sentence in SENTENCE_RE.split(text):
+        sentence = sentence.strip()
+        if sentence:
+            sentences.extend(_split_words(sentence, limit) if len(sentence) > limit else [sentence])
+    return sentences
+
+
+def split_long_text(text, chunk_size, chunk_overlap, prefix=""):
+    """
+    Упаковывает предложения в чанки до chunk_size символов (с учетом prefix).
+    Следующий чанк начинается с последних предложений предыдущего общей длиной
+    не больше chunk_overlap.
+    """
+    limit = max(1, chunk_size - len(prefix))
+    chunks, current = [], []
+    for sentence in split_sentences(text, limit):
+        if current and len(" ".join(current + [sentence])) > limit:
+            chunks.append(prefix + " ".join(current))
+            overlap = []
+            for previous in reversed(current):
+                if len(" ".join([previous] + overlap)) > chunk_overlap:
+                    break
+                overlap.insert(0, previous)
+            while overlap and len(" ".join(overlap + [sentence])) > limit:
+                overlap.pop(0)
+            current = overlap
+        current.append(sentence)
+    if current:
+        chunks.append(prefix + " ".join(current))
+    return chunks
+
+
+def split_qa(unit, chunk_size, chunk_overlap):
+    """Пара вопрос-ответ целиком, а слишком длинная — части ответа с повторенным вопросом."""
+    if len(unit) <= chunk_size * QA_MAX_FACTOR:
+        return [unit]
+    match = ANSWER_RE.search(unit)
+    if match is None or match.end() > chunk_size // 2:
+        return split_long_text(unit, chunk_size, chunk_overlap)
+    prefix = unit[:match.end()] + " "
+    return split_long_text(unit[match.end():].strip(), chunk_size, chunk_overlap, prefix)
+
+
+def chunk_text(text, chunk_size=1000, chunk_overlap=200):
+    """Разбивает текст на чанки по структуре (см. описание модуля)."""
+    chunks, packed = [], ""
+    for unit, is_qa in split_units(text):
+        if not is_qa and len(unit) <= chunk_size:
+            if packed and len(packed) + 1 + len(unit) > chunk_size:
+                chunks.append(packed)
+                packed = ""
+            packed = f"{packed}\n{unit}" if packed else unit
+            continue
+        if packed:
+            chunks.append(packed)
+            packed = ""
+        if is_qa:
+            chunks.extend(split_qa(unit, chunk_size, chunk_overlap))
+        else:
+            chunks.extend(split_long_text(unit, chunk_size, chunk_overlap))
+    if packed:
+        chunks.append(packed)
+    return chunks
+
+
+def chunk_sources(texts, chunk_size=1000, chunk_overlap=200, workers=None):
+    """
+    Чанки для каждого текста (в исходном порядке). Больше PARALLEL_MIN_SOURCES
+    источников делятся в пуле процессов: чанкинг упирается в CPU и GIL.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunker = partial(chunk_text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    if workers <= 1 or len(texts) < PARALLEL_MIN_SOURCES:
+        return [chunker(text) for text in texts]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(chunker, texts, chunksize=max(1, len(texts) // (workers * 4))))
+
+
+# --- ПОЧТИ ОДИНАКОВЫЕ ЧАНКИ ---
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Множество хэшей словесных n-грамм нормализованного текста (стабильных между процессами)."""
+    words = WORD_RE.findall(text.lower().replace("ё", "е"))
+    if len(words) <= size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))}
+    return {zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)}
+
+
+def minhash(shingle_set):
+    """MinHash-подпись: доля совпадающих позиций двух подписей оценивает коэффициент Жаккара."""
+    values = np.fromiter(shingle_set, dtype=np.int64, count=len(shingle_set)) & _MERSENNE_PRIME
+    signature = (np.outer(_MINHASH_A, values) + _MINHASH_B[:, None]) % _MERSENNE_PRIME
+    return signature.min(axis=1).astype(np.int32)
+
+
+def near_duplicate_mask(texts, threshold=DEDUPE_THRESHOLD):
+    """
+    Маска «оставить» для списка текстов: текст отбрасывается, если среди уже
+    оставленных есть похожий с коэффициентом Жаккара по n-граммам >= threshold.
+    Кандидаты ищутся через MinHash LSH (LSH_BANDS полос), сходство оценивается
+    по подписям — в памяти держится 256 байт на чанк, а не множества n-грамм.
+    """
+    rows = MINHASH_PERMUTATIONS // LSH_BANDS
+    buckets = {}
+    signatures = {}
+    keep = []
+    for i, text in enumerate(texts):
+        signature = minhash(shingles(text))
+        keys = [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(LSH_BANDS)]
+        candidates = {j for key in keys for j in buckets.get(key, ())}
+        duplicate = any(np.mean(signature == signatures[j]) >= threshold for j in candidates)
+        keep.append(not duplicate)
+        if not duplicate:
+            signatures[i] = signature
+            for key in keys:
+                buckets.setdefault(key, []).append(i)
+    return keep
@@ -0,0 +1,250 @@
+import os
+import threading
+import time
+
+from pymongo import monitoring
+
+
+def require_env(name: str) -> str:
+    value = os.getenv(name)
+    if not value:
+        raise ValueError(f"❌ {name} не найден в .env файле!")
+    return value
+
+
+class LazyClient:
+    """
+    Прокси к внешнему клиенту (MongoDB, OpenAI): клиент создается фабрикой при первом
+    обращении и заново в каждом процессе. Соединения и потоки, открытые в мастере
+    gunicorn --preload, нельзя переносить через fork в воркеры; этому же правилу
+    следуют SQLite-кэши (caches.py) и наблюдатель векторных баз (vector_index.py).
+    Атрибуты и индексация (db["collection"]) прозрачно передаются клиенту.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = self._factory()
+                    self._pid = pid
+        return self._client
+
+    @property
+    def created(self) -> bool:
+        return self._client is not None and self._pid == os.getpid()
+
+    def reset(self):
+        """Забывает клиент; следующее обращение создаст новый."""
+        with self._lock:
+            client, self._client = self._client, None
+        return client if self._pid == os.getpid() else None
+
+    def close(self):
+        """Закрывает клиент текущего процесса и забывает его."""
+        client = self.reset()
+        if client is not None:
+            client.close()
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, default))
+
+
+def env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, "1" if default else "0").lower() in ("1", "true", "yes")
+
+
+def mongo_client_options(pool_metrics=None) -> dict:
+    """Пулы и таймауты MongoClient из MONGO_* (значения по умолчанию рассчитаны на один воркер)."""
+    options = {
+        "maxPoolSize": env_int("MONGO_MAX_POOL_SIZE", 50),
+        "minPoolSize": env_int("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": env_int("MONGO_MAX_IDLE_TIME_MS", 60000),
+        "waitQueueTimeoutMS": env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 2000),
+        "serverSelectionTimeoutMS": env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+        "connectTimeoutMS": env_int("MONGO_CONNECT_TIMEOUT_MS", 5000),
+        "socketTimeoutMS": env_int("MONGO_SOCKET_TIMEOUT_MS", 15000),
+        "retryReads": env_flag("MONGO_RETRY_READS", True),
+        "retryWrites": env_flag("MONGO_RETRY_WRITES", True),
+    }
+    if pool_metrics is not None:
+        options["event_listeners"] = [pool_metrics]
+    return options
+
+
+def openai_client_settings() -> dict:
+    """Таймауты (секунды), ретраи и лимит одновременных запросов к OpenAI из OPENAI_*."""
+    return {
+        "timeout": env_float("OPENAI_TIMEOUT", 30),
+        "connect_timeout": env_float("OPENAI_CONNECT_TIMEOUT", 5),
+        "pool_timeout": env_float("OPENAI_POOL_TIMEOUT", 10),
+        "max_retries": env_int("OPENAI_MAX_RETRIES", 2),
+        "max_in_flight": env_int("OPENAI_MAX_IN_FLIGHT", 20),
+        "max_keepalive": env_int("OPENAI_MAX_KEEPALIVE", 10),
+        "keepalive_expiry": env_float("OPENAI_KEEPALIVE_EXPIRY", 30),
+    }
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Загрузка пулов соединений MongoDB по адресам серверов (события pymongo)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._pools = {}
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def _pool(self, address):
+        key = f"{address[0]}:{address[1]}"
+        return self._pools.setdefault(key, {"max_pool_size": None, "connections": 0, "checked_out": 0})
+
+    def pool_created(self, event):
+        with self._lock:
+            self._pool(event.address)["max_pool_size"] = event.options.get("maxPoolSize")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        with self._lock:
+            self._pool(event.address)["connections"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["connections"] = max(0, pool["connections"] - 1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self._pool(event.address)["checked_out"] += 1
+            self.checkouts += 1
+            wait = event.duration or 0.0
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            pool = self._pool(event.address)
+            pool["checked_out"] = max(0, pool["checked_out"] - 1)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            pools = {
+                address: dict(pool, utilization=(pool["checked_out"] / pool["max_pool_size"]
+                                                 if pool["max_pool_size"] else 0.0))
+                for address, pool in self._pools.items()
+            }
+            return {
+                "pools": pools,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_checkout_wait_ms": self.total_wait / self.checkouts * 1000 if self.checkouts else 0.0,
+                "max_checkout_wait_ms": self.max_wait * 1000,
+            }
+
+
+class HttpPoolMetrics:
+    """
+    Запросы к HTTP API (OpenAI) в полете относительно лимита пула, ошибки и задержки.
+    in_flight включает запросы, ждущие свободного соединения, поэтому utilization > 1
+    означает очередь к пулу.
+    """
+
+    def __init__(self, max_in_flight=None):
+        self._lock = threading.Lock()
+        self.max_in_flight = max_in_flight
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.in_flight = 0
+            self.peak_in_flight = 0
+            self.requests = 0
+            self.errors = 0
+            self.throttled = 0
+            self.total_latency = 0.0
+
+    def start(self) -> float:
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return time.monotonic()
+
+    def finish(self, started_at: float, status_code=None, error=False):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.total_latency += time.monotonic() - started_at
+            if error or (status_code is not None and status_code >= 500):
+                self.errors += 1
+            if status_code == 429:
+                self.throttled += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            finished = self.requests - self.in_flight
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "utilization": self.in_flight / self.max_in_flight if self.max_in_flight else 0.0,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "errors": self.errors,
+                "throttled": self.throttled,
+                "avg_latency_ms": self.total_latency / finished * 1000 if finished else 0.0,
+            }
+
+
+# Метрики пулов процесса по именам — для админского эндпоинта
+POOL_METRICS = {}
+
+
+def register_pool_metrics(name: str, metrics):
+    POOL_METRICS[name] = metrics
+    return metrics
+
+
+def pool_metrics_snapshot() -> dict:
+    return {name: metrics.snapshot() for name, metrics in POOL_METRICS.items()}
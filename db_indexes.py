@@ -0,0 +1,124 @@
+"""
+Индексы MongoDB для горячих запросов приложения.
+
+Создание индексов (идемпотентно): python db_indexes.py
+Планы выполнения горячих запросов: python db_indexes.py --explain [--user-id <ObjectId>]
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta
+
+import certifi
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from pymongo.errors import OperationFailure
+
+INDEXES = {
+    "transactions": [
+        IndexModel([("userId", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="userId_createdAt_id"),
+        IndexModel([("userId", ASCENDING), ("type", ASCENDING), ("createdAt", DESCENDING)],
+                   name="userId_type_createdAt"),
+    ],
+    "chat_history": [
+        IndexModel([("userId", ASCENDING), ("timestamp", DESCENDING)], name="userId_timestamp"),
+    ],
+    "accounts": [
+        IndexModel([("userId", ASCENDING)], name="userId"),
+    ],
+    "goals": [
+        IndexModel([("userId", ASCENDING), ("status", ASCENDING)], name="userId_status"),
+    ],
+    "spending_daily": [
+        IndexModel([("userId", ASCENDING), ("day", DESCENDING)], name="userId_day_unique", unique=True),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+}
+
+
+def ensure_indexes(db):
+    """Создает недостающие индексы. Повторный вызов ничего не меняет."""
+    for collection_name, models in INDEXES.items():
+        try:
+            created = db[collection_name].create_indexes(models)
+            print(f"✓ Индексы {collection_name}: {', '.join(created)}")
+        except OperationFailure as e:
+            # Например, уникальный индекс не строится из-за дубликатов — приложение продолжает работу
+            print(f"⚠️ Не удалось создать индексы для {collection_name}: {e}")
+
+
+def hot_queries(user_id):
+    """Горячие запросы приложения в виде (описание, коллекция, фильтр, сортировка, лимит)."""
+    user_oid = ObjectId(user_id)
+    month_ago = datetime.utcnow() - timedelta(days=30)
+    return [
+        ("GET /api/transactions", "transactions",
+         {"userId": user_oid, "createdAt": {"$gte": month_ago}}, [("createdAt", DESCENDING), ("_id", DESCENDING)], 100),
+        ("analyze_spending_habits", "spending_daily",
+         {"userId": user_oid, "day": {"$gte": month_ago}}, None, 0),
+        ("analyze_spending_habits (fallback)", "transactions",
+         {"userId": user_oid, "createdAt": {"$gte": month_ago}, "type": "expense"}, None, 0),
+        ("chat history", "chat_history",
+         {"userId": user_oid}, [("timestamp", DESCENDING)], 3),
+        ("accounts", "accounts", {"userId": user_oid}, None, 0),
+        ("goals", "goals", {"userId": user_oid}, None, 0),
+        ("login", "users", {"username": "user@example.com"}, None, 0),
+    ]
+
+
+def _plan_stages(plan):
+    stages = []
+    while plan:
+        stages.append(plan.get("stage") + (f"({plan['indexName']})" if plan.get("indexName") else ""))
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " <- ".join(stages)
+
+
+def explain_hot_queries(db, user_id=None):
+    """Печатает план выполнения и статистику для каждого горячего запроса."""
+    if user_id is None:
+        user = db.users.find_one(sort=[("createdAt", -1)])
+        user_id = user["_id"] if user else ObjectId()
+
+    print("\n" + "=" * 60)
+    print(f"ПЛАНЫ ЗАПРОСОВ (userId: {user_id})")
+    print("=" * 60)
+
+    for title, collection_name, query, sort, limit in hot_queries(user_id):
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        explain = cursor.explain()
+        stats = explain.get("executionStats", {})
+        plan = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        marker = "⚠️" if "COLLSCAN" in plan else "✓"
+        print(f"\n{marker} {title} [{collection_name}]")
+        print(f"   План: {plan}")
+        print(f"   Возвращено: {stats.get('nReturned')}, ключей просмотрено: {stats.get('totalKeysExamined')}, "
+              f"документов просмотрено: {stats.get('totalDocsExamined')}, "
+              f"время: {stats.get('executionTimeMillis')} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Индексы MongoDB и планы горячих запросов")
+    parser.add_argument("--explain", action="store_true", help="Показать планы выполнения горячих запросов")
+    parser.add_argument("--user-id", help="Пользователь для explain (по умолчанию — последний зарегистрированный)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    mongo_client = MongoClient(os.getenv("MONGO_URI"), tlsCAFile=certifi.where())
+    db = mongo_client["E-commerce"]
+
+    ensure_indexes(db)
+    if args.explain:
+        explain_hot_queries(db, args.user_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Настройки модели эмбеддингов: модель и размерность берутся из EMBEDDING_MODEL /
+EMBEDDING_DIMENSIONS и должны совпадать у prepare_data.py (индекс) и main.py (запросы).
+
+Модели text-embedding-3 поддерживают параметр dimensions: API возвращает первые
+d координат полного вектора, заново нормированные, поэтому качество поиска на
+меньшей размерности можно оценить по уже построенной полной базе:
+    python embeddings.py --benchmark --store vector_database.json [--query-store vector_database_kk.json]
+    python embeddings.py --benchmark --size 100000      # задержка скана на синтетике
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+DEFAULT_EMBEDDING_MODEL = "text-embedding-3-small"
+NATIVE_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+BENCHMARK_DIMENSIONS = (256, 512, 1536)
+
+
+def embedding_settings(model=None, dimensions=None):
+    """
+    {"model", "dimensions"} из аргументов или EMBEDDING_MODEL / EMBEDDING_DIMENSIONS.
+    dimensions — None для родной размерности модели.
+    """
+    model = model or os.getenv("EMBEDDING_MODEL", DEFAULT_EMBEDDING_MODEL)
+    dimensions = dimensions or (int(os.getenv("EMBEDDING_DIMENSIONS")) if os.getenv("EMBEDDING_DIMENSIONS") else None)
+    if dimensions == NATIVE_DIMENSIONS.get(model):
+        dimensions = None
+    if dimensions is not None and not model.startswith("text-embedding-3"):
+        raise ValueError(f"❌ Модель {model} не поддерживает EMBEDDING_DIMENSIONS")
+    if dimensions is not None and dimensions <= 0:
+        raise ValueError(f"❌ Некорректная размерность эмбеддингов: {dimensions}")
+    return {"model": model, "dimensions": dimensions}
+
+
+def embedding_dimensions(embedding):
+    """Ожидаемая длина вектора (None — если модель неизвестна и размерность не задана)."""
+    return embedding["dimensions"] or NATIVE_DIMENSIONS.get(embedding["model"])
+
+
+def embedding_id(embedding):
+    """
+    Идентификатор векторного пространства для ключей кэша и хэшей чанков:
+    "модель" для родной размерности (как раньше) или "модель@d".
+    """
+    if embedding["dimensions"] is None:
+        return embedding["model"]
+    return f"{embedding['model']}@{embedding['dimensions']}"
+
+
+def embedding_request_kwargs(embedding):
+    """Аргументы embeddings.create: dimensions передается, только если задан."""
+    kwargs = {"model": embedding["model"]}
+    if embedding["dimensions"] is not None:
+        kwargs["dimensions"] = embedding["dimensions"]
+    return kwargs
+
+
+def truncate_embeddings(matrix, dimensions):
+    """Первые dimensions координат с повторной нормировкой — то же, что возвращает API text-embedding-3."""
+    truncated = np.asarray(matrix, dtype=np.float32)[..., :dimensions]
+    norms = np.linalg.norm(truncated, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return truncated / norms
+
+
+# --- БЕНЧМАРК ---
+
+def _top_k(matrix, queries, top_k, exclude_self=False):
+    sims = queries @ matrix.T
+    if exclude_self:
+        np.fill_diagonal(sims, -np.inf)
+    return np.argsort(-sims, axis=1)[:, :top_k]
+
+
+def quality_benchmark(matrix, queries=None, top_k=5, dims=BENCHMARK_DIMENSIONS):
+    """
+    recall@k поиска на урезанных векторах относительно полной размерности.
+    Без queries каждый чанк ищет ближайшие к себе среди остальных (leave-one-out).
+    """
+    exclude_self = queries is None
+    queries = matrix if queries is None else queries
+    top_k = min(top_k, len(matrix) - exclude_self)
+    truth = _top_k(matrix, queries, top_k, exclude_self)
+    print(f"\n{'размерность':>12} | {'recall@' + str(top_k):>10}")
+    for d in dims:
+        if d > matrix.shape[1]:
+            continue
+        found = _top_k(truncate_embeddings(matrix, d), truncate_embeddings(queries, d), top_k, exclude_self)
+        hits = sum(len(set(a) & set(b)) for a, b in zip(truth, found))
+        print(f"{d:>12} | {hits / truth.size:>10.3f}")
+
+
+def speed_benchmark(size, queries=100, top_k=10, dims=BENCHMARK_DIMENSIONS):
+    """Задержка точного скана и размер float32-матрицы для каждой размерности."""
+    from ann_index import latency_percentiles, synthetic_vectors
+    from vector_index import VectorIndex
+
+    full = synthetic_vectors(size + queries, max(dims))
+    print(f"\n{'размерность':>12} | {'память, МБ':>10} | {'p50, мс':>8} | {'p95, мс':>8}")
+    for d in dims:
+        matrix = truncate_embeddings(full, d)
+        labels = [""] * size
+        index = VectorIndex(matrix[:size], labels, labels, normalized=True)
+        timings = []
+        for query in matrix[size:]:
+            started = time.perf_counter()
+            index.top_k_indices(query, top_k)
+            timings.append(time.perf_counter() - started)
+        p50, p95 = latency_percentiles(timings)
+        print(f"{d:>12} | {index.matrix.nbytes / 2 ** 20:>10.1f} | {p50:>8.2f} | {p95:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Эмбеддинги: качество и скорость поиска при разной размерности")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--store", help="Векторная база полной размерности для оценки качества")
+    parser.add_argument("--query-store", help="База, векторы которой используются как запросы (например, другой язык)")
+    parser.add_argument("--size", type=int, default=100000, help="Размер синтетической базы для замера скорости")
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        parser.print_help()
+        return
+
+    if args.store:
+        from vector_index import load_vector_index
+        matrix = np.asarray(load_vector_index(args.store, dtype="float32").matrix)
+        queries = np.asarray(load_vector_index(args.query_store, dtype="float32").matrix) if args.query_store else None
+        print(f"📚 {args.store}: {matrix.shape[0]} × {matrix.shape[1]}")
+        quality_benchmark(matrix, queries, args.top_k)
+    else:
+        print(f"🎲 Синтетическая база: {args.size} векторов")
+        speed_benchmark(args.size, top_k=args.top_k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import re
+
+
+def trie_pattern(keywords) -> str:
+    """
+    Регулярное выражение-префиксное дерево: (?:ма(?:газин(?: одежды)?|...)|...).
+    В каждой позиции ветвление идет по одному символу, совпадение — самое длинное.
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """
+    Поиск подстрок-ключевых слов за один проход по тексту.
+
+    Таблица {метка: [ключевые слова]} (или просто список слов) компилируется один раз
+    в регулярное выражение-дерево. Поиск перезапускается со следующего символа после
+    начала каждого совпадения, поэтому перекрывающиеся слова («как» / «какой») не теряются,
+    а участки без совпадений пропускаются внутри движка re. Результат совпадает
+    с проверкой `keyword in text` для каждого слова.
+    """
+
+    def __init__(self, table):
+        if not isinstance(table, dict):
+            table = {None: table}
+        self.labels = list(table)
+
+        self._label_order = {}
+        for order, (label, keywords) in enumerate(table.items()):
+            for keyword in keywords:
+                self._label_order.setdefault(keyword.lower(), (order, label))
+
+        keywords = list(self._label_order)
+        self._regex = re.compile(trie_pattern(keywords))
+        # Слова, начинающиеся в той же позиции, — префиксы самого длинного совпадения
+        self._prefixes = {keyword: [other for other in keywords if keyword.startswith(other)] for keyword in keywords}
+
+    def search(self, text: str) -> bool:
+        """Есть ли в тексте хотя бы одно ключевое слово."""
+        return self._regex.search(text.lower()) is not None
+
+    def find_all(self, text: str) -> set:
+        """Множество всех ключевых слов, встречающихся в тексте (включая перекрывающиеся)."""
+        text = text.lower()
+        found = set()
+        match = self._regex.search(text)
+        while match:
+            found.update(self._prefixes[match.group()])
+            match = self._regex.search(text, match.start() + 1)
+        return found
+
+    def count(self, text: str) -> int:
+        return len(self.find_all(text))
+
+    def first_label(self, text: str, default=None):
+        """Первая по порядку таблицы метка, у которой нашлось ключевое слово."""
+        orders = [self._label_order[keyword] for keyword in self.find_all(text)]
+        return min(orders, key=lambda item: item[0])[1] if orders else default
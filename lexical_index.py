@@ -0,0 +1,77 @@
+import math
+import re
+
+import numpy as np
+
+_TOKEN_RE = re.compile(r"\w+")
+STEM_LENGTH = 6
+
+
+def tokenize(text):
+    """
+    Токены для BM25: нижний регистр, ё→е, слова обрезаются до STEM_LENGTH символов —
+    грубый, но языконезависимый стемминг для русских и казахских словоформ.
+    """
+    words = _TOKEN_RE.findall((text or "").lower().replace("ё", "е"))
+    return [word[:STEM_LENGTH] for word in words if len(word) > 1 or word.isdigit()]
+
+
+class BM25Index:
+    """Инвертированный индекс с ранжированием Okapi BM25 по content чанков."""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(documents)
+
+        postings = {}
+        lengths = np.zeros(self.size, dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize(document)
+            lengths[doc_id] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc_id, count))
+
+        average_length = float(lengths.mean()) if self.size else 0.0
+        # Нормировка длины документа считается один раз при построении
+        norms = k1 * (1 - b + b * lengths / average_length) if average_length else np.full(self.size, k1)
+
+        self._postings = {}
+        for token, entries in postings.items():
+            doc_ids = np.array([doc_id for doc_id, _ in entries], dtype=np.intp)
+            tf = np.array([count for _, count in entries], dtype=np.float32)
+            df = len(entries)
+            idf = math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+            self._postings[token] = (doc_ids, (idf * tf * (k1 + 1) / (tf + norms[doc_ids])).astype(np.float32))
+
+    def __len__(self):
+        return self.size
+
+    def scores(self, query):
+        scores = np.zeros(self.size, dtype=np.float32)
+        for token in set(tokenize(query)):
+            posting = self._postings.get(token)
+            if posting is not None:
+                scores[posting[0]] += posting[1]
+        return scores
+
+    def top_k_indices(self, query, top_k=2):
+        """Индексы top_k документов с ненулевым счетом по убыванию BM25."""
+        scores = self.scores(query)
+        matched = np.flatnonzero(scores)
+        if len(matched) == 0 or top_k <= 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.float32)
+        order = matched[np.argsort(-scores[matched], kind='stable')][:top_k]
+        return order, scores[order]
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Сливает несколько ранжирований индексов: score = Σ 1 / (k + rank)."""
+    fused = {}
+    for ranking in rankings:
+        for rank, index in enumerate(ranking, start=1):
+            fused[int(index)] = fused.get(int(index), 0.0) + 1.0 / (k + rank)
+    return sorted(fused, key=lambda index: -fused[index])
@@ -1,13 +1,20 @@
+import time
+IMPORT_STARTED_AT = time.perf_counter()
+
+import hmac
 import os
+import re
+import threading
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 import bcrypt
 import certifi
 import json
-import numpy as np
 import pytz
 from dotenv import load_dotenv
-from flask import Flask, request, render_template, redirect, url_for, session, jsonify
-from openai import OpenAI
+from flask import Flask, Response, request, render_template, redirect, url_for, session, jsonify, stream_with_context
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime
 from bson import ObjectId
 from bson.decimal128 import Decimal128
@@ -15,123 +22,151 @@ from bson.json_util import dumps
 from datetime import datetime, timedelta
 import pytz
 from bson.decimal128 import Decimal128
-from langdetect import detect, DetectorFactory
-DetectorFactory.seed = 0
+from db_indexes import ensure_indexes
+from keyword_matcher import KeywordMatcher
+from caches import embedding_cache_from_env, response_cache_from_env, user_context_cache_from_env
+from transaction_import import detect_import_format, import_transactions, iter_import_rows
+from spending_aggregates import (aggregates_cover, daily_spending_query, daily_totals, delete_user_spending,
+                                 mark_spending_complete, record_spending_safely, spending_coverage_query, window_start,
+                                 DEFAULT_CATEGORY, COLLECTION as SPENDING_COLLECTION,
+                                 COVERAGE_COLLECTION as SPENDING_COVERAGE_COLLECTION)
+from embeddings import embedding_id, embedding_request_kwargs, embedding_settings
+from vector_index import DEFAULT_RERANK, VectorIndexManager, load_vector_index
+from clients import (HttpPoolMetrics, LazyClient, MongoPoolMetrics, mongo_client_options, openai_client_settings,
+                     pool_metrics_snapshot, register_pool_metrics, require_env)
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.config['SECRET_KEY'] = 'a-very-secret-key-for-sessions'
 
 load_dotenv(os.path.join(os.path.abspath(os.path.dirname(__file__)), '.env'))
 
-openai_api_key = os.getenv("OPENAI_API_KEY")
+DB_NAME = "E-commerce"
 
-if not openai_api_key:
-    raise ValueError("❌ OPENAI_API_KEY не найден в .env файле!")
 
-openai_client = OpenAI(api_key=openai_api_key)
-print(f"✓ OpenAI API инициализирован успешно")
+mongo_pool_metrics = register_pool_metrics("mongo", MongoPoolMetrics())
+openai_http_metrics = register_pool_metrics("openai", HttpPoolMetrics())
 
-MONGO_URI = os.getenv("MONGO_URI")
-if not MONGO_URI:
-    raise ValueError("❌ MONGO_URI не найден в .env файле!")
 
-ca = certifi.where()
-mongo_client = MongoClient(MONGO_URI, tlsCAFile=ca)
-db = mongo_client["E-commerce"]
-if "transactions" not in db.list_collection_names():
-    db.create_collection("transactions")
-    print("✓ Коллекция transactions создана")
+def create_openai_client():
+    # Импорт openai занимает сотни миллисекунд — откладываем до первого запроса
+    from openai import OpenAI
+    from openai_http import openai_client_kwargs
+    openai_http_metrics.reset()
+    return OpenAI(
+        api_key=require_env("OPENAI_API_KEY"),
+        **openai_client_kwargs(openai_client_settings(), openai_http_metrics)
+    )
 
-print(f"✓ MongoDB подключена успешно")
-print(f"✓ База данных: E-commerce")
-print(f"✓ Все системы готовы к работе!\n")
 
-vector_database_ru = []
-vector_database_kk = []
+def create_mongo_client():
+    mongo_pool_metrics.reset()
+    return MongoClient(require_env("MONGO_URI"), tlsCAFile=certifi.where(),
+                       **mongo_client_options(mongo_pool_metrics))
 
 
-def load_vector_databases():
-    global vector_database_ru, vector_database_kk
+# Клиенты создаются при первом обращении, отдельно в каждом воркере
+openai_client = LazyClient(create_openai_client)
+mongo_client = LazyClient(create_mongo_client)
+db = LazyClient(lambda: mongo_client.get()[DB_NAME])
 
-    try:
-        with open("vector_database.json", "r", encoding="utf-8") as f:
-            vector_database_ru = json.load(f)
-            for item in vector_database_ru:
-                item['vector'] = np.array(item['vector'])
-        print(f"✓ Русская база знаний успешно загружена. Записей: {len(vector_database_ru)}")
-    except FileNotFoundError:
-        print("⚠ ПРЕДУПРЕЖДЕНИЕ: Файл vector_database.json (RU) не найден.")
-        print("  Запустите prepare_data.py для создания русской базы знаний.")
+embedding_cache = embedding_cache_from_env()
+response_cache = response_cache_from_env()
+user_context_cache = user_context_cache_from_env()
 
-    try:
-        with open("vector_database_kk.json", "r", encoding="utf-8") as f:
-            vector_database_kk = json.load(f)
-            for item in vector_database_kk:
-                item['vector'] = np.array(item['vector'])
-        print(f"✓ Казахская база знаний успешно загружена. Записей: {len(vector_database_kk)}")
-    except FileNotFoundError:
-        print("⚠ ПРЕДУПРЕЖДЕНИЕ: Файл vector_database_kk.json (KK) не найден.")
-        print("  Запустите prepare_data.py для создания казахской базы знаний.")
+BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+# Модель и размерность эмбеддингов запросов (EMBEDDING_MODEL / EMBEDDING_DIMENSIONS);
+# индекс, собранный другой моделью или размерностью, не загружается
+EMBEDDING = embedding_settings()
 
-def get_embedding(text, model="text-embedding-3-small"):
-    return openai_client.embeddings.create(input=[text], model=model).data[0].embedding
+vector_indexes = VectorIndexManager(
+    {
+        "ru": os.path.join(BASE_DIR, "vector_database.json"),
+        "kk": os.path.join(BASE_DIR, "vector_database_kk.json"),
+    },
+    poll_interval=int(os.getenv("VECTOR_RELOAD_INTERVAL", 30)),
+    # VECTOR_DTYPE (float32/float16/int8) переопределяет тип, выбранный в prepare_data.py --dtype;
+    # VECTOR_RERANK — сколько кандидатов квантованного поиска переранжировать по float32 (0 — не переранжировать)
+    loader=partial(load_vector_index, dtype=os.getenv("VECTOR_DTYPE") or None,
+                   rerank=int(os.getenv("VECTOR_RERANK", DEFAULT_RERANK)), embedding=EMBEDDING),
+)
 
 
-def cosine_similarity(vec1, vec2):
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+def load_vector_databases(force=False):
+    return vector_indexes.reload_all(force=force)
 
 
-def find_most_relevant_chunk(user_question_vector, top_k=2):
-    if not vector_database:
-        return []
+def _request_embedding(text, embedding=EMBEDDING):
+    return openai_client.embeddings.create(input=[text], **embedding_request_kwargs(embedding)).data[0].embedding
 
-    similarities = [
-        (cosine_similarity(user_question_vector, item['vector']), item['content'], item['source'])
-        for item in vector_database
-    ]
-    similarities.sort(key=lambda x: x[0], reverse=True)
-    return [(content, source) for sim, content, source in similarities[:top_k]]
+
+def get_embedding(text, embedding=EMBEDDING):
+    return embedding_cache.get_or_compute(text, embedding_id(embedding), lambda t: _request_embedding(t, embedding))
+
+
+RAG_RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "hybrid")
+# Порог BM25, выше которого вопрос считается «очевидным по ключевым словам» и эмбеддинг не запрашивается; 0 — выключено
+RAG_LEXICAL_SKIP_SCORE = float(os.getenv("RAG_LEXICAL_SKIP_SCORE", 0))
 
 
 def find_most_relevant_chunk(user_question_vector, vector_db, top_k=2):
     if not vector_db:
         return []
-
-    similarities = [
-        (cosine_similarity(user_question_vector, item['vector']), item['content'], item['source'])
-        for item in vector_db
-    ]
-    similarities.sort(key=lambda x: x[0], reverse=True)
-    return [(content, source) for sim, content, source in similarities[:top_k]]
+    return vector_db.search(user_question_vector, top_k=top_k)
 
 
+def retrieve_chunks(message: str, question_vector, vector_db, top_k=2) -> list:
+    """
+    Поиск чанков: гибридный (векторы + BM25, RRF) по умолчанию, чисто векторный
+    при RAG_RETRIEVAL_MODE=vector, чисто лексический — если эмбеддинга нет.
+    """
+    if not vector_db:
+        return []
+    if question_vector is None:
+        return vector_db.lexical_search(message, top_k=top_k)
+    if RAG_RETRIEVAL_MODE == "vector":
+        return find_most_relevant_chunk(question_vector, vector_db, top_k=top_k)
+    if RAG_RETRIEVAL_MODE == "lexical":
+        return vector_db.lexical_search(message, top_k=top_k)
+    return vector_db.hybrid_search(question_vector, message, top_k=top_k)
+
+
+def needs_embedding(message: str, vector_db) -> bool:
+    """Эмбеддинг не нужен в лексическом режиме и для вопросов с уверенным BM25-совпадением."""
+    if RAG_RETRIEVAL_MODE == "lexical":
+        return False
+    if RAG_LEXICAL_SKIP_SCORE <= 0 or not vector_db:
+        return True
+    _, scores = vector_db.lexical.top_k_indices(message, top_k=1)
+    return not (len(scores) and scores[0] >= RAG_LEXICAL_SKIP_SCORE)
+
+
+KK_CHARS_RE = re.compile('[ӘәІіҢңҒғҮүҰұҚқӨөҺһ]')
+
+RU_MARKERS = KeywordMatcher([
+    'хочу', 'нужно', 'нужен', 'нужна', 'можно', 'скажи', 'расскажи',
+    'открыть', 'закрыть', 'получить', 'взять', 'оформить',
+    'какой', 'какая', 'какие', 'который', 'где', 'когда', 'почему',
+    'это', 'что', 'как', 'мне', 'меня', 'тебя', 'вас',
+    'банк', 'счет', 'карту', 'кредит', 'займ'
+])
+
+KK_MARKERS = KeywordMatcher([
+    'қалай', 'неше', 'қандай', 'маған', 'саған', 'сізге',
+    'керек', 'тиіс', 'үшін', 'туралы', 'арқылы', 'бойынша',
+    'қайда', 'қашан', 'неге', 'себебі',
+    'алайын', 'берейін', 'жасайын', 'ашайын',
+    'банкте', 'шот', 'аламын', 'қаржы', 'несие'
+])
+
+
+@lru_cache(maxsize=4096)
 def detect_language(text):
-    kk_chars = set('ӘәІіҢңҒғҮүҰұҚқӨөҺһ')
-
-    if any(char in kk_chars for char in text):
+    if KK_CHARS_RE.search(text):
         return 'kk'
 
-    ru_markers = [
-        'хочу', 'нужно', 'нужен', 'нужна', 'можно', 'скажи', 'расскажи',
-        'открыть', 'закрыть', 'получить', 'взять', 'оформить',
-        'какой', 'какая', 'какие', 'который', 'где', 'когда', 'почему',
-        'это', 'что', 'как', 'мне', 'меня', 'тебя', 'вас',
-        'банк', 'счет', 'карту', 'кредит', 'займ'
-    ]
-
-    kk_markers = [
-        'қалай', 'неше', 'қандай', 'маған', 'саған', 'сізге',
-        'керек', 'тиіс', 'үшін', 'туралы', 'арқылы', 'бойынша',
-        'қайда', 'қашан', 'неге', 'себебі',
-        'алайын', 'берейін', 'жасайын', 'ашайын',
-        'банкте', 'шот', 'аламын', 'қаржы', 'несие'
-    ]
-
-    text_lower = text.lower()
-
-    ru_score = sum(1 for marker in ru_markers if marker in text_lower)
-    kk_score = sum(1 for marker in kk_markers if marker in text_lower)
+    ru_score = RU_MARKERS.count(text)
+    kk_score = KK_MARKERS.count(text)
 
     if ru_score >= 2 and kk_score == 0:
         return 'ru'
@@ -139,20 +174,12 @@ def detect_language(text):
     if kk_score >= 1:
         return 'kk'
 
-    if ru_score >= 1:
-        return 'ru'
-
-    try:
-        detected = detect(text)
-        return detected if detected in ['ru', 'kk'] else 'ru'
-    except:
-        return 'ru'
+    # Ни казахских букв, ни казахских маркеров: у langdetect нет профиля kk, так что он ничего не добавил бы
+    return 'ru'
 
 
-def detect_intent_to_open_product(message: str, lang: str) -> bool:
-    message_lower = message.lower()
-
-    kk_triggers = [
+PRODUCT_TRIGGERS = {
+    'kk': KeywordMatcher([
         'карта аш', 'карта алайын', 'карта керек', 'карта ашу', 'карта алғым',
         'депозит аш', 'депозит ашайын', 'депозит керек', 'депозит ашу', 'депозит алғым',
         'несие ал', 'несие алайын', 'несие керек', 'несие алу', 'несие алғым',
@@ -160,9 +187,8 @@ def detect_intent_to_open_product(message: str, lang: str) -> bool:
         'шот аш', 'шот ашайын', 'шот керек', 'шот ашу', 'шот алғым',
         'өтінім беру', 'өтінім жасау', 'рәсімдеу',
         'тіркелу', 'тіркелгім келеді', 'тіркелгім'
-    ]
-
-    ru_triggers = [
+    ]),
+    'ru': KeywordMatcher([
         'открыть карт', 'открою карт', 'хочу карт', 'нужна карт', 'оформить карт', 'карту открыть',
         'открыть депозит', 'открою депозит', 'хочу депозит', 'нужен депозит', 'оформить депозит', 'депозит открыть',
         'взять кредит', 'возьму кредит', 'хочу кредит', 'нужен кредит', 'оформить кредит', 'кредит взять',
@@ -172,148 +198,407 @@ def detect_intent_to_open_product(message: str, lang: str) -> bool:
         'зарегистрироваться', 'регистрация', 'стать клиентом',
         'давай откро', 'давай оформ', 'давай возьм', 'давай созда',
         'помоги открыть', 'помоги оформить', 'помоги получить'
-    ]
+    ]),
+}
 
-    triggers = kk_triggers if lang == 'kk' else ru_triggers
 
-    match_found = any(trigger in message_lower for trigger in triggers)
+def detect_intent_to_open_product(message: str, lang: str) -> bool:
+    triggers = PRODUCT_TRIGGERS['kk'] if lang == 'kk' else PRODUCT_TRIGGERS['ru']
+
+    match_found = triggers.search(message)
 
     if match_found:
-        print(f"✓ Найден триггер для открытия продукта в сообщении: '{message_lower[:50]}...'")
+        print(f"✓ Найден триггер для открытия продукта в сообщении: '{message.lower()[:50]}...'")
 
     return match_found
 
 
-def get_rag_response(user_id: str, message: str) -> dict:
-    lang = 'ru'
+PERSONAL_WORDS = {
+    'мой', 'моя', 'мои', 'мое', 'моих', 'моим', 'моей', 'мне', 'меня', 'я',
+    'менің', 'маған', 'мені', 'мен'
+}
+PERSONAL_STEMS = ['баланс', 'цель', 'цели', 'накоп', 'шотым', 'мақсат', 'жинағ']
+
+
+ANALYTICS_KEYWORDS = KeywordMatcher([
+    'анализ', 'расход', 'трат', 'статистик', 'аналитик', 'где я трачу',
+    'на что уходит', 'сколько трачу', 'мои траты'
+])
+
+
+def detect_analytics_request(message: str) -> bool:
+    return ANALYTICS_KEYWORDS.search(message)
+
+
+def is_personal_question(message: str) -> bool:
+    text = message.lower().replace('ё', 'е')
+    if PERSONAL_WORDS.intersection(re.findall(r"\w+", text)):
+        return True
+    return any(stem in text for stem in PERSONAL_STEMS)
+
+
+def save_chat_exchange(user_id: str, message: str, bot_reply: str):
+    db.chat_history.insert_one({
+        "userId": ObjectId(user_id),
+        "role": "user",
+        "message": message,
+        "timestamp": datetime.utcnow()
+    })
+    db.chat_history.insert_one({
+        "userId": ObjectId(user_id),
+        "role": "assistant",
+        "message": bot_reply,
+        "timestamp": datetime.utcnow()
+    })
+    print("✓ История сохранена")
+
+
+def build_rag_result(bot_reply: str, should_open_bank_site: bool) -> dict:
+    return {
+        "reply": bot_reply,
+        "open_bank_site": should_open_bank_site,
+        "bank_url": "https://www.zamanbank.kz/" if should_open_bank_site else None
+    }
+
+
+def resolve_language(message: str) -> str:
+    detected_lang = detect_language(message)
+    print(f"🌍 Обнаружен язык: {detected_lang}")
+
+    lang = 'kk' if detected_lang == 'kk' else 'ru'
+    print(f"📝 Используется логика для: '{lang}'")
+    print(f"📨 Сообщение: '{message}'")
+    return lang
 
+
+rag_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RAG_EXECUTOR_WORKERS", 32)),
+    thread_name_prefix="rag-stage"
+)
+
+RAG_STAGE_TIMEOUTS = {
+    "embedding": float(os.getenv("RAG_EMBEDDING_TIMEOUT", 10)),
+    "user": float(os.getenv("RAG_DB_TIMEOUT", 3)),
+    "accounts": float(os.getenv("RAG_DB_TIMEOUT", 3)),
+    "goals": float(os.getenv("RAG_DB_TIMEOUT", 3)),
+    "chat_history": float(os.getenv("RAG_DB_TIMEOUT", 3)),
+    "analytics": float(os.getenv("RAG_ANALYTICS_TIMEOUT", 5)),
+}
+
+
+def collect_stage(name: str, future, started_at: float, default):
+    """
+    Дожидается результата этапа RAG с учетом его таймаута (отсчет от общего старта).
+    При таймауте или ошибке этап деградирует до значения по умолчанию.
+    """
+    remaining = max(0.0, started_at + RAG_STAGE_TIMEOUTS[name] - time.monotonic())
     try:
-        detected_lang = detect_language(message)
-        print(f"🌍 Обнаружен язык: {detected_lang}")
+        return future.result(timeout=remaining)
+    except FuturesTimeoutError:
+        future.cancel()
+        print(f"⏱️ Этап '{name}' превысил таймаут {RAG_STAGE_TIMEOUTS[name]}с, используется значение по умолчанию")
+    except Exception as e:
+        print(f"⚠️ Ошибка на этапе '{name}': {e}")
+    return default
 
-        lang = 'kk' if detected_lang == 'kk' else 'ru'
-        print(f"📝 Используется логика для: '{lang}'")
-        print(f"📨 Сообщение: '{message}'")
 
-        should_open_bank_site = detect_intent_to_open_product(message, lang)
-        print(f"🔗 Намерение открыть продукт: {should_open_bank_site}")
+# Из профиля в промпт идет только имя; остальное (в т.ч. хэш пароля) не читается и не попадает в кэш
+USER_CONTEXT_FIELDS = {"profile": 1}
 
-        wants_analytics = any(keyword in message.lower() for keyword in [
-            'анализ', 'расход', 'трат', 'статистик', 'аналитик', 'где я трачу',
-            'на что уходит', 'сколько трачу', 'мои траты'
-        ])
 
-        vector_database = vector_database_kk if lang == 'kk' else vector_database_ru
+def cached_user_context(user_id: str):
+    """Профиль, счета и цели клиента из кэша или None при промахе."""
+    if user_context_cache is None:
+        return None
+    return user_context_cache.get(user_id)
 
-        print(f"🤖 Обработка RAG для пользователя {user_id} на языке '{lang}'")
 
-        user = db.users.find_one({"_id": ObjectId(user_id)})
-        user_accounts = list(db.accounts.find({"userId": ObjectId(user_id)}))
-        user_goals = list(db.goals.find({"userId": ObjectId(user_id)}))
-        first_name = user.get('profile', {}).get('firstName', 'друг') if user else 'друг'
-        print(f"👤 Имя пользователя: {first_name}")
-
-        analytics_context = ""
-        if wants_analytics:
-            print("📊 Клиент запросил аналитику расходов")
-            analysis = analyze_spending_habits(user_id)
-            if analysis:
-                recommendations = generate_personalized_recommendations(user_id, analysis, user_goals)
-                if lang == 'kk':
-                    analytics_context = f"\n\n### КЛИЕНТТІҢ ШЫҒЫСТАРЫ ТАЛДАУЫ:\n"
-                    analytics_context += f"Жалпы шығыстар: {analysis['total_expenses']:,.0f}₸\n"
-                    analytics_context += f"Ең көп шығын категориясы: {analysis['top_category']}\n"
-                    if recommendations:
-                        analytics_context += f"\nПерсоналды ұсыныстар:\n{recommendations}\n"
-                else:
-                    analytics_context = f"\n\n### АНАЛИЗ РАСХОДОВ КЛИЕНТА:\n"
-                    analytics_context += f"Общие расходы за месяц: {analysis['total_expenses']:,.0f}₸\n"
-                    analytics_context += f"Топ категория: {analysis['top_category']}\n"
-                    if recommendations:
-                        analytics_context += f"\nПерсональные рекомендации:\n{recommendations}\n"
-
-        astana_tz = pytz.timezone('Asia/Almaty')
-        current_time = datetime.now(astana_tz)
-        hour = current_time.hour
+def remember_user_context(user_id: str, user, user_accounts, user_goals) -> dict:
+    """
+    Собирает контекст клиента из результатов этапов. None означает, что этап не успел
+    или упал: такой контекст не кэшируется, а в промпте данные помечаются недоступными.
+    """
+    context = {"user": user, "accounts": user_accounts, "goals": user_goals}
+    if user_context_cache is not None and None not in (user, user_accounts, user_goals):
+        user_context_cache.set(user_id, context)
+    return context
+
+
+def invalidate_user_context(user_id):
+    if user_context_cache is not None:
+        user_context_cache.invalidate(user_id)
+
+
+def plan_rag_request(user_id: str, message: str, lang: str) -> dict:
+    """Шаги без ввода-вывода до запуска этапов RAG (общие для main.py и asgi_app.py)."""
+    should_open_bank_site = detect_intent_to_open_product(message, lang)
+    print(f"🔗 Намерение открыть продукт: {should_open_bank_site}")
+
+    wants_analytics = detect_analytics_request(message)
+
+    vector_database = vector_indexes.get(lang)
 
+    print(f"🤖 Обработка RAG для пользователя {user_id} на языке '{lang}'")
+    return {
+        "lang": lang,
+        "should_open_bank_site": should_open_bank_site,
+        "wants_analytics": wants_analytics,
+        "vector_database": vector_database,
+        "needs_embedding": needs_embedding(message, vector_database)
+    }
+
+
+def retrieve_rag_context(user_id: str, message: str, plan: dict, question_vector):
+    """
+    Поиск чанков и проверка кэша ответов. Возвращает (chunks_with_sources, rag_request):
+    rag_request уже готов, если ответ взят из кэша или вопрос кэшируемый — тогда данные
+    клиента не нужны и их этапы можно отменить; иначе None.
+    """
+    lang = plan["lang"]
+    if not plan["needs_embedding"]:
+        print("🔤 Вопрос распознан по ключевым словам, эмбеддинг не запрашивается")
+    elif question_vector is None:
+        print("⚠️ Эмбеддинг недоступен, используется лексический поиск (BM25)")
+    chunks_with_sources = retrieve_chunks(message, question_vector, plan["vector_database"], top_k=2)
+
+    cache_key, cached_reply = lookup_cached_reply(
+        lang, message, question_vector, chunks_with_sources, plan["should_open_bank_site"], plan["wants_analytics"]
+    )
+    if cached_reply is not None:
+        return chunks_with_sources, {
+            "lang": lang,
+            "should_open_bank_site": plan["should_open_bank_site"],
+            "cached_reply": cached_reply
+        }
+    if cache_key is not None:
+        return chunks_with_sources, shared_rag_request(
+            user_id, message, lang, plan["should_open_bank_site"], chunks_with_sources, cache_key, question_vector
+        )
+    return chunks_with_sources, None
+
+
+def personal_rag_request(user_id: str, message: str, plan: dict, chunks_with_sources: list, question_vector,
+                         user_context: dict, analysis, chat_history: list) -> dict:
+    """Запрос с данными клиента и историей переписки; такой ответ не кэшируется."""
+    messages, _ = build_rag_messages(
+        user_id, message, plan["lang"], plan["should_open_bank_site"], chunks_with_sources,
+        user_context["user"], user_context["accounts"], user_context["goals"], analysis, chat_history
+    )
+    return {
+        "lang": plan["lang"],
+        "should_open_bank_site": plan["should_open_bank_site"],
+        "cached_reply": None,
+        "messages": messages,
+        "cache_key": None,
+        "question_vector": question_vector
+    }
+
+
+def prepare_rag_request(user_id: str, message: str, lang: str) -> dict:
+    plan = plan_rag_request(user_id, message, lang)
+
+    # Чтения из Mongo и эмбеддинг независимы — запускаем их параллельно
+    user_oid = ObjectId(user_id)
+    user_context = cached_user_context(user_id)
+    stages = {
+        "chat_history": rag_executor.submit(
+            lambda: list(db.chat_history.find({"userId": user_oid}).sort("timestamp", -1).limit(3))
+        ),
+    }
+    if plan["needs_embedding"]:
+        stages["embedding"] = rag_executor.submit(get_embedding, message)
+    if user_context is None:
+        stages["user"] = rag_executor.submit(db.users.find_one, {"_id": user_oid}, USER_CONTEXT_FIELDS)
+        stages["accounts"] = rag_executor.submit(lambda: list(db.accounts.find({"userId": user_oid})))
+        stages["goals"] = rag_executor.submit(lambda: list(db.goals.find({"userId": user_oid})))
+    if plan["wants_analytics"]:
+        stages["analytics"] = rag_executor.submit(analyze_spending_habits, user_id)
+    started_at = time.monotonic()
+
+    print(f"🔍 Поиск в базе знаний ('{lang}')...")
+    question_vector = None
+    if "embedding" in stages:
+        question_vector = collect_stage("embedding", stages["embedding"], started_at, None)
+        print(f"🧠 Кэш эмбеддингов: {embedding_cache.stats()}")
+
+    chunks_with_sources, rag_request = retrieve_rag_context(user_id, message, plan, question_vector)
+    if rag_request is not None:
+        for future in stages.values():
+            future.cancel()
+        return rag_request
+
+    if user_context is None:
+        user_context = remember_user_context(
+            user_id,
+            collect_stage("user", stages["user"], started_at, None),
+            collect_stage("accounts", stages["accounts"], started_at, None),
+            collect_stage("goals", stages["goals"], started_at, None)
+        )
+    else:
+        print(f"👤 Профиль клиента взят из кэша: {user_context_cache.stats()}")
+    analysis = None
+    if plan["wants_analytics"]:
+        print("📊 Клиент запросил аналитику расходов")
+        analysis = collect_stage("analytics", stages["analytics"], started_at, None)
+    chat_history = collect_stage("chat_history", stages["chat_history"], started_at, [])
+
+    return personal_rag_request(user_id, message, plan, chunks_with_sources, question_vector,
+                                user_context, analysis, chat_history)
+
+
+def lookup_cached_reply(lang: str, message: str, question_vector, chunks_with_sources: list,
+                        should_open_bank_site: bool, wants_analytics: bool):
+    """Возвращает (cache_key, cached_reply); cache_key=None, если вопрос не кэшируется."""
+    if (response_cache is None or question_vector is None or not chunks_with_sources
+            or wants_analytics or is_personal_question(message)):
+        return None, None
+
+    cache_key = response_cache.make_key(
+        lang, [item[0] for item in chunks_with_sources], should_open_bank_site
+    )
+    cached_reply = response_cache.get(cache_key, question_vector)
+    if cached_reply is not None:
+        print(f"⚡ Ответ взят из кэша ответов: {response_cache.stats()}")
+    return cache_key, cached_reply
+
+
+def shared_rag_request(user_id: str, message: str, lang: str, should_open_bank_site: bool,
+                       chunks_with_sources: list, cache_key: str, question_vector) -> dict:
+    """
+    Запрос для кэшируемого вопроса: ответ попадет в общий кэш и будет выдан другим
+    клиентам, поэтому промпт строится без персональных данных и истории переписки.
+    """
+    messages, _ = build_rag_messages(
+        user_id, message, lang, should_open_bank_site, chunks_with_sources,
+        None, [], [], None, [], personalized=False
+    )
+    return {
+        "lang": lang,
+        "should_open_bank_site": should_open_bank_site,
+        "cached_reply": None,
+        "messages": messages,
+        "cache_key": cache_key,
+        "question_vector": question_vector
+    }
+
+
+def cache_rag_reply(rag_request: dict, bot_reply: str):
+    """Кладет ответ в общий кэш; cache_key есть только у запросов из shared_rag_request."""
+    cache_key = rag_request.get("cache_key")
+    if cache_key is not None and bot_reply.strip():
+        response_cache.set(cache_key, rag_request["question_vector"], bot_reply)
+
+
+def build_rag_messages(user_id: str, message: str, lang: str, should_open_bank_site: bool,
+                       chunks_with_sources: list, user, user_accounts, user_goals,
+                       analysis, chat_history: list, personalized: bool = True):
+    """
+    Собирает system/user промпты из уже загруженных данных клиента. Возвращает (messages, first_name).
+    personalized=False — промпт без персональных данных и истории (для ответов в общий кэш).
+    """
+    first_name = user.get('profile', {}).get('firstName', 'друг') if user else 'друг'
+    print(f"👤 Имя пользователя: {first_name}")
+
+    analytics_context = ""
+    if analysis:
+        recommendations = generate_personalized_recommendations(user_id, analysis, user_goals)
         if lang == 'kk':
-            if 5 <= hour < 12:
-                time_greeting = "Қайырлы таң"
-            elif 12 <= hour < 17:
-                time_greeting = "Қайырлы күн"
-            elif 17 <= hour < 22:
-                time_greeting = "Қайырлы кеш"
-            else:
-                time_greeting = "Қайырлы түн"
-            accounts_header = "\nКлиенттің шоттары:\n"
-            goals_header = "\nКлиенттің қаржылық мақсаттары:\n"
-            no_data_msg = "Клиентте әлі шоттар немесе мақсаттар жоқ.\n"
+            analytics_context = f"\n\n### КЛИЕНТТІҢ ШЫҒЫСТАРЫ ТАЛДАУЫ:\n"
+            analytics_context += f"Жалпы шығыстар: {analysis['total_expenses']:,.0f}₸\n"
+            analytics_context += f"Ең көп шығын категориясы: {analysis['top_category']}\n"
+            if recommendations:
+                analytics_context += f"\nПерсоналды ұсыныстар:\n{recommendations}\n"
         else:
-            if 5 <= hour < 12:
-                time_greeting = "Доброе утро"
-            elif 12 <= hour < 17:
-                time_greeting = "Добрый день"
-            elif 17 <= hour < 22:
-                time_greeting = "Добрый вечер"
-            else:
-                time_greeting = "Доброй ночи"
-            accounts_header = "\nСчета клиента:\n"
-            goals_header = "\nФинансовые цели клиента:\n"
-            no_data_msg = "У клиента пока нет счетов или целей.\n"
-
-        personal_context = f"### Персональные данные клиента:\nИмя: {first_name}\n"
-        if not user_accounts and not user_goals:
-            personal_context += no_data_msg
-        if user_accounts:
-            personal_context += accounts_header
-            for acc in user_accounts:
-                balance_value = acc.get('balance')
-                balance_str = str(balance_value) if isinstance(balance_value, Decimal128) else '0'
-                personal_context += f"- '{acc.get('accountName', 'N/A')}' шоты, баланс: {balance_str} {acc.get('currency', 'KZT')}\n"
-        if user_goals:
-            personal_context += goals_header
-            for goal in user_goals:
-                current_str = str(goal.get('currentAmount')) if isinstance(goal.get('currentAmount'),
-                                                                           Decimal128) else '0'
-                target_str = str(goal.get('targetAmount')) if isinstance(goal.get('targetAmount'), Decimal128) else '0'
-                personal_context += f"- '{goal.get('goalName', 'N/A')}' мақсаты. Жиналған: {current_str} / {target_str} KZT\n"
-        personal_context += "###\n\n"
-
-        personal_context += analytics_context
-
-        chat_history = list(db.chat_history.find({"userId": ObjectId(user_id)}).sort("timestamp", -1).limit(3))
-        chat_history.reverse()
-        is_first_message = len(chat_history) == 0
-
-
-        history_context = ""
-        if chat_history:
-            history_context = "### История предыдущих сообщений:\n"
-            for msg in chat_history:
-                role = "Клиент" if msg.get('role') == 'user' else "Амир"
-                history_context += f"{role}: {msg.get('message', '')}\n"
-            history_context += "###\n\n"
-
-        print(f"🔍 Поиск в базе знаний ('{lang}')...")
-        question_vector = get_embedding(message)
-        chunks_with_sources = find_most_relevant_chunk(np.array(question_vector), vector_db=vector_database, top_k=2)
-
-        context_str = "Білім базасында деректер жоқ." if lang == 'kk' else "Нет данных в базе знаний."
-        if chunks_with_sources:
-            context_chunks = [item[0] for item in chunks_with_sources]
-            context_str = "\n\n".join(context_chunks)
-            print(f"✓ Найдено релевантных фрагментов: {len(chunks_with_sources)}")
-
-        if should_open_bank_site:
-            if lang == 'kk':
-                product_instruction = "\n\nМАҢЫЗДЫ: Клиент өнім ашқысы келеді. Оған өнім туралы қысқаша айтып, содан кейін: 'Мен сізді Zaman Bank сайтына бағыттап жатырмын, онда сіз өтінім жасай аласыз!' деп жаз."
-            else:
-                product_instruction = "\n\nВАЖНО: Клиент хочет открыть продукт. Расскажи ему кратко о продукте, а затем скажи: 'Сейчас я перенаправлю вас на сайт Zaman Bank, где вы сможете оформить заявку!'"
+            analytics_context = f"\n\n### АНАЛИЗ РАСХОДОВ КЛИЕНТА:\n"
+            analytics_context += f"Общие расходы за месяц: {analysis['total_expenses']:,.0f}₸\n"
+            analytics_context += f"Топ категория: {analysis['top_category']}\n"
+            if recommendations:
+                analytics_context += f"\nПерсональные рекомендации:\n{recommendations}\n"
+
+    astana_tz = pytz.timezone('Asia/Almaty')
+    current_time = datetime.now(astana_tz)
+    hour = current_time.hour
+
+    if lang == 'kk':
+        if 5 <= hour < 12:
+            time_greeting = "Қайырлы таң"
+        elif 12 <= hour < 17:
+            time_greeting = "Қайырлы күн"
+        elif 17 <= hour < 22:
+            time_greeting = "Қайырлы кеш"
         else:
-            product_instruction = ""
-
+            time_greeting = "Қайырлы түн"
+        accounts_header = "\nКлиенттің шоттары:\n"
+        goals_header = "\nКлиенттің қаржылық мақсаттары:\n"
+        no_data_msg = "Клиентте әлі шоттар немесе мақсаттар жоқ.\n"
+        unavailable_msg = "Клиенттің шоттары мен мақсаттары туралы деректер қазір қолжетімсіз.\n"
+    else:
+        if 5 <= hour < 12:
+            time_greeting = "Доброе утро"
+        elif 12 <= hour < 17:
+            time_greeting = "Добрый день"
+        elif 17 <= hour < 22:
+            time_greeting = "Добрый вечер"
+        else:
+            time_greeting = "Доброй ночи"
+        accounts_header = "\nСчета клиента:\n"
+        goals_header = "\nФинансовые цели клиента:\n"
+        no_data_msg = "У клиента пока нет счетов или целей.\n"
+        unavailable_msg = "Данные о счетах и целях клиента сейчас недоступны — не делай выводов об их наличии.\n"
+
+    personal_context = f"### Персональные данные клиента:\nИмя: {first_name}\n"
+    # None — данные не загрузились (таймаут/ошибка этапа), это не то же самое, что их отсутствие
+    if user_accounts is None or user_goals is None:
+        personal_context += unavailable_msg
+    elif not user_accounts and not user_goals:
+        personal_context += no_data_msg
+    if user_accounts:
+        personal_context += accounts_header
+        for acc in user_accounts:
+            balance_value = acc.get('balance')
+            balance_str = str(balance_value) if isinstance(balance_value, Decimal128) else '0'
+            personal_context += f"- '{acc.get('accountName', 'N/A')}' шоты, баланс: {balance_str} {acc.get('currency', 'KZT')}\n"
+    if user_goals:
+        personal_context += goals_header
+        for goal in user_goals:
+            current_str = str(goal.get('currentAmount')) if isinstance(goal.get('currentAmount'),
+                                                                       Decimal128) else '0'
+            target_str = str(goal.get('targetAmount')) if isinstance(goal.get('targetAmount'), Decimal128) else '0'
+            personal_context += f"- '{goal.get('goalName', 'N/A')}' мақсаты. Жиналған: {current_str} / {target_str} KZT\n"
+    personal_context += "###\n\n"
+
+    personal_context += analytics_context
+    if not personalized:
+        personal_context = ""
+
+    chat_history = list(reversed(chat_history))
+    is_first_message = len(chat_history) == 0
+
+
+    history_context = ""
+    if chat_history and personalized:
+        history_context = "### История предыдущих сообщений:\n"
+        for msg in chat_history:
+            role = "Клиент" if msg.get('role') == 'user' else "Амир"
+            history_context += f"{role}: {msg.get('message', '')}\n"
+        history_context += "###\n\n"
+
+    context_str = "Білім базасында деректер жоқ." if lang == 'kk' else "Нет данных в базе знаний."
+    if chunks_with_sources:
+        context_chunks = [item[0] for item in chunks_with_sources]
+        context_str = "\n\n".join(context_chunks)
+        print(f"✓ Найдено релевантных фрагментов: {len(chunks_with_sources)}")
+
+    if should_open_bank_site:
         if lang == 'kk':
-            system_prompt = f"""Сенің рөлің: Сен — Әмір, Zaman Bank-тің жеке қаржы тілімгері және психологиялық қолдаушы.
+            product_instruction = "\n\nМАҢЫЗДЫ: Клиент өнім ашқысы келеді. Оған өнім туралы қысқаша айтып, содан кейін: 'Мен сізді Zaman Bank сайтына бағыттап жатырмын, онда сіз өтінім жасай аласыз!' деп жаз."
+        else:
+            product_instruction = "\n\nВАЖНО: Клиент хочет открыть продукт. Расскажи ему кратко о продукте, а затем скажи: 'Сейчас я перенаправлю вас на сайт Zaman Bank, где вы сможете оформить заявку!'"
+    else:
+        product_instruction = ""
+
+    if lang == 'kk':
+        system_prompt = f"""Сенің рөлің: Сен — Әмір, Zaman Bank-тің жеке қаржы тілімгері және психологиялық қолдаушы.
 
 МАҢЫЗДЫ: Жауапты ТӘУЕЛСІЗ қазақ тілінде беру керек. Ешбір орыс сөздерін қолданба!
 
@@ -341,9 +626,9 @@ def get_rag_response(user_id: str, message: str) -> dict:
 ✗ Білім базасында жоқ ақпаратты ойдан шығарма
 ✗ ЕШБІР ** немесе * белгілерін қолданба!
 ✗ Тек қарапайым мәтінмен жауап бер!{product_instruction}"""
-            user_prompt = f"{personal_context}{history_context}БІЛІМ БАЗАСЫНАН АЛЫНҒАН КОНТЕКСТ:\n{context_str}\n\nКЛИЕНТТІҢ АҒЫМДАҒЫ СҰРАҒЫ:\n{message}\n\nНҰСҚАУ: Жауапты қазақ тілінде бер."
-        else:
-            system_prompt = f"""Твоя роль: Ты — Амир, персональный финансовый наставник и психолог поддержки от Zaman Bank.
+        user_prompt = f"{personal_context}{history_context}БІЛІМ БАЗАСЫНАН АЛЫНҒАН КОНТЕКСТ:\n{context_str}\n\nКЛИЕНТТІҢ АҒЫМДАҒЫ СҰРАҒЫ:\n{message}\n\nНҰСҚАУ: Жауапты қазақ тілінде бер."
+    else:
+        system_prompt = f"""Твоя роль: Ты — Амир, персональный финансовый наставник и психолог поддержки от Zaman Bank.
 
 ВАЖНО: Отвечай ТОЛЬКО на русском языке!
 
@@ -373,145 +658,199 @@ def get_rag_response(user_id: str, message: str) -> dict:
 ✗ Не придумывай информацию, которой нет в базе знаний.
 ✗ НЕ используй ** или * символы!
 ✗ Отвечай только обычным текстом!{product_instruction}"""
-            user_prompt = f"{personal_context}{history_context}КОНТЕКСТ ИЗ БАЗЫ ЗНАНИЙ:\n{context_str}\n\nТЕКУЩИЙ ВОПРОС КЛИЕНТА:\n{message}\n\nИНСТРУКЦИЯ: Ответь на русском языке."
+        user_prompt = f"{personal_context}{history_context}КОНТЕКСТ ИЗ БАЗЫ ЗНАНИЙ:\n{context_str}\n\nТЕКУЩИЙ ВОПРОС КЛИЕНТА:\n{message}\n\nИНСТРУКЦИЯ: Ответь на русском языке."
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    return messages, first_name
+
+
+def finish_rag_response(user_id: str, message: str, rag_request: dict, bot_reply: str) -> dict:
+    cache_rag_reply(rag_request, bot_reply)
+
+    save_chat_exchange(user_id, message, bot_reply)
+    return build_rag_result(bot_reply, rag_request["should_open_bank_site"])
+
+
+def rag_error_message(lang: str) -> str:
+    return "Кешіріңіз, қате пайда болды. Қайта көріңізші." if lang == 'kk' else "Извините, произошла ошибка. Пожалуйста, попробуйте еще раз."
+
+
+def rag_error_result(lang: str) -> dict:
+    return {
+        "reply": rag_error_message(lang),
+        "open_bank_site": False,
+        "bank_url": None
+    }
+
+
+def rag_completion_kwargs(rag_request: dict, stream: bool = False) -> dict:
+    """Параметры chat.completions.create для ответа на вопрос клиента (sync и async)."""
+    kwargs = {
+        "model": "gpt-4o-mini",
+        "messages": rag_request["messages"],
+        "max_tokens": 600,
+        "temperature": 0.7
+    }
+    if stream:
+        kwargs["stream"] = True
+    return kwargs
+
+
+def clean_reply_text(text: str) -> str:
+    # Удаление всех '*' (в том числе по частям потока) эквивалентно .replace('**', '').replace('*', '')
+    return (text or '').replace('*', '')
+
+
+def stream_chunk_text(chunk) -> str:
+    """Очищенный текст очередной части потокового ответа ('' для служебных частей)."""
+    if not chunk.choices:
+        return ''
+    return clean_reply_text(chunk.choices[0].delta.content)
+
+
+def get_rag_response(user_id: str, message: str) -> dict:
+    lang = 'ru'
+
+    try:
+        lang = resolve_language(message)
+        rag_request = prepare_rag_request(user_id, message, lang)
+
+        if rag_request["cached_reply"] is not None:
+            return finish_rag_response(user_id, message, rag_request, rag_request["cached_reply"])
 
         print("🚀 Отправка запроса к AI...")
-        response = openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=600,
-            temperature=0.7
-        )
-        bot_reply = response.choices[0].message.content
-        bot_reply = bot_reply.replace('**', '').replace('*', '')
+        response = openai_client.chat.completions.create(**rag_completion_kwargs(rag_request))
+        bot_reply = clean_reply_text(response.choices[0].message.content)
         print(f"✓ Получен ответ от AI")
 
-        db.chat_history.insert_one({
-            "userId": ObjectId(user_id),
-            "role": "user",
-            "message": message,
-            "timestamp": datetime.utcnow()
-        })
-        db.chat_history.insert_one({
-            "userId": ObjectId(user_id),
-            "role": "assistant",
-            "message": bot_reply,
-            "timestamp": datetime.utcnow()
-        })
-        print("✓ История сохранена")
-
-        return {
-            "reply": bot_reply,
-            "open_bank_site": should_open_bank_site,
-            "bank_url": "https://www.zamanbank.kz/" if should_open_bank_site else None
-        }
+        return finish_rag_response(user_id, message, rag_request, bot_reply)
 
     except Exception as e:
         print(f"✗ Ошибка в get_rag_response: {e}")
         import traceback
         traceback.print_exc()
 
-        error_msg = "Кешіріңіз, қате пайда болды. Қайта көріңізші." if lang == 'kk' else "Извините, произошла ошибка. Пожалуйста, попробуйте еще раз."
+        return rag_error_result(lang)
 
-        return {
-            "reply": error_msg,
-            "open_bank_site": False,
-            "bank_url": None
-        }
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-def categorize_transaction(description: str) -> str:
-    categories = {
-        'Продукты': ['магазин', 'супермаркет', 'grocery', 'мегамарт', 'small', 'продукты'],
-        'Транспорт': ['бензин', 'заправка', 'такси', 'яндекс', 'uber', 'автобус', 'метро'],
-        'Развлечения': ['кино', 'кафе', 'ресторан', 'бар', 'клуб', 'концерт', 'игры'],
-        'Одежда': ['zara', 'h&m', 'одежда', 'обувь', 'магазин одежды'],
-        'Здоровье': ['аптека', 'клиника', 'больница', 'врач', 'лекарства'],
-        'Связь': ['beeline', 'kcell', 'altel', 'интернет', 'телефон'],
-        'Образование': ['курс', 'обучение', 'книга', 'университет'],
-        'Переводы': ['перевод', 'transfer', 'другу', 'родителям']
-    }
 
-    desc_lower = description.lower()
-    for category, keywords in categories.items():
-        if any(keyword in desc_lower for keyword in keywords):
-            return category
-    return 'Прочее'
+def rag_meta_event(rag_request: dict) -> str:
+    """Первое SSE-событие потока: open_bank_site/bank_url без текста ответа."""
+    meta = build_rag_result("", rag_request["should_open_bank_site"])
+    del meta["reply"]
+    return sse_event("meta", meta)
 
 
-def analyze_spending_habits(user_id: str) -> dict:
+def stream_rag_response(user_id: str, message: str):
+    """
+    Потоковый вариант get_rag_response: генератор SSE-событий
+    meta (open_bank_site/bank_url) -> token* -> done | error.
+    """
+    lang = 'ru'
+
     try:
-        print(f"📊 Начало анализа для пользователя: {user_id}")
+        lang = resolve_language(message)
+        rag_request = prepare_rag_request(user_id, message, lang)
+        yield rag_meta_event(rag_request)
 
-        one_month_ago = datetime.utcnow() - timedelta(days=30)
+        if rag_request["cached_reply"] is not None:
+            bot_reply = rag_request["cached_reply"]
+            yield sse_event("token", {"text": bot_reply})
+        else:
+            print("🚀 Потоковый запрос к AI...")
+            stream = openai_client.chat.completions.create(**rag_completion_kwargs(rag_request, stream=True))
+            reply_parts = []
+            for chunk in stream:
+                text = stream_chunk_text(chunk)
+                if text:
+                    reply_parts.append(text)
+                    yield sse_event("token", {"text": text})
+            bot_reply = "".join(reply_parts)
+            print("✓ Потоковый ответ от AI завершен")
+
+        yield sse_event("done", finish_rag_response(user_id, message, rag_request, bot_reply))
 
-        transactions = list(db.transactions.find({
-            "userId": ObjectId(user_id),
-            "createdAt": {"$gte": one_month_ago},
-            "type": "expense"
-        }))
+    except Exception as e:
+        print(f"✗ Ошибка в stream_rag_response: {e}")
+        import traceback
+        traceback.print_exc()
 
-        print(f"🔍 Найдено транзакций: {len(transactions)}")
+        yield sse_event("error", rag_error_result(lang))
 
-        if len(transactions) == 0:
-            print("⚠️ Нет транзакций для анализа")
-            return None
 
-        category_totals = {}
-        night_spending = 0
-        total_expenses = 0
+TRANSACTION_CATEGORIES = KeywordMatcher({
+    'Продукты': ['магазин', 'супермаркет', 'grocery', 'мегамарт', 'small', 'продукты'],
+    'Транспорт': ['бензин', 'заправка', 'такси', 'яндекс', 'uber', 'автобус', 'метро'],
+    'Развлечения': ['кино', 'кафе', 'ресторан', 'бар', 'клуб', 'концерт', 'игры'],
+    'Одежда': ['zara', 'h&m', 'одежда', 'обувь', 'магазин одежды'],
+    'Здоровье': ['аптека', 'клиника', 'больница', 'врач', 'лекарства'],
+    'Связь': ['beeline', 'kcell', 'altel', 'интернет', 'телефон'],
+    'Образование': ['курс', 'обучение', 'книга', 'университет'],
+    'Переводы': ['перевод', 'transfer', 'другу', 'родителям']
+})
 
-        for tx in transactions:
-            amount_field = tx.get('amount')
 
-            if amount_field is None:
-                print(f"⚠️ Транзакция без amount: {tx.get('_id')}")
-                continue
+KNOWN_CATEGORIES = frozenset(TRANSACTION_CATEGORIES.labels) | {DEFAULT_CATEGORY}
 
-            if isinstance(amount_field, Decimal128):
-                amount = float(amount_field.to_decimal())
-            elif isinstance(amount_field, dict) and '$numberDecimal' in amount_field:
-                amount = float(amount_field['$numberDecimal'])
-            elif isinstance(amount_field, (int, float)):
-                amount = float(amount_field)
-            else:
-                print(f"⚠️ Неизвестный формат amount: {type(amount_field)}, значение: {amount_field}")
-                continue
 
-            total_expenses += amount
+def categorize_transaction(description: str) -> str:
+    return TRANSACTION_CATEGORIES.first_label(description, default=DEFAULT_CATEGORY)
 
-            category = categorize_transaction(tx.get('description', ''))
-            category_totals[category] = category_totals.get(category, 0) + amount
 
-            tx_date = tx.get('createdAt')
-            if tx_date and isinstance(tx_date, datetime):
-                tx_hour = tx_date.hour
-                if tx_hour >= 23 or tx_hour < 6:
-                    night_spending += amount
+PERIOD_DAYS = {'week': 7, 'month': 30, 'year': 365}
 
-        print(f"💰 Общая сумма расходов: {total_expenses:,.0f}₸")
-        print(f"📊 Категории: {category_totals}")
 
-        if category_totals:
-            top_category = max(category_totals.items(), key=lambda x: x[1])
-        else:
-            top_category = ('Прочее', 0)
-
-        result = {
-            "total_expenses": total_expenses,
-            "categories": category_totals,
-            "top_category": top_category[0],
-            "top_category_amount": top_category[1],
-            "night_spending": night_spending,
-            "night_spending_percentage": (night_spending / total_expenses * 100) if total_expenses > 0 else 0
-        }
+def spending_query(user_id: str, days: int = 30) -> dict:
+    # Окно то же, что у дневных агрегатов: результат не зависит от выбранного пути
+    return {
+        "userId": ObjectId(user_id),
+        "createdAt": {"$gte": window_start(days)},
+        "type": "expense"
+    }
+
+
+def spending_pipeline(user_id: str, days: int = 30) -> list:
+    """
+    Агрегация расходов по сырым транзакциям на стороне Mongo: суммы по сохраненной
+    категории и ночные траты (23:00-06:00 UTC). Используется, пока дневные агрегаты
+    пользователя (spending_aggregates.py) не покрывают все окно.
+    """
+    night_hour = {"$or": [{"$gte": ["$hour", 23]}, {"$lt": ["$hour", 6]}]}
+    return [
+        {"$match": spending_query(user_id, days)},
+        {"$project": {
+            "_id": 0,
+            "amount": {"$convert": {"input": "$amount", "to": "double", "onError": None, "onNull": None}},
+            "category": {"$ifNull": ["$category", DEFAULT_CATEGORY]},
+            "hour": {"$hour": "$createdAt"}
+        }},
+        {"$match": {"amount": {"$ne": None}}},
+        {"$group": {
+            "_id": "$category",
+            "total": {"$sum": "$amount"},
+            "night": {"$sum": {"$cond": [night_hour, "$amount", 0]}},
+            "count": {"$sum": 1}
+        }}
+    ]
+
+
+def analyze_spending_habits(user_id: str, days: int = 30) -> dict:
+    try:
+        print(f"📊 Начало анализа для пользователя: {user_id}")
+        # Агрегаты читаются, только если в них учтены все транзакции окна (см. spending_aggregates.py)
+        coverage = db[SPENDING_COVERAGE_COLLECTION].find_one(spending_coverage_query(user_id))
+        if aggregates_cover(coverage, days):
+            daily_docs = list(db[SPENDING_COLLECTION].find(daily_spending_query(user_id, days)))
+            return summarize_totals(*daily_totals(daily_docs))
 
-        print(f"✅ Анализ завершен успешно")
-        print(f"📈 Результат: {result}")
-        return result
+        category_groups = list(db.transactions.aggregate(spending_pipeline(user_id, days)))
+        return summarize_spending(category_groups)
 
     except Exception as e:
         print(f"❌ Ошибка в analyze_spending_habits: {e}")
@@ -520,6 +859,45 @@ def analyze_spending_habits(user_id: str) -> dict:
         return None
 
 
+def summarize_spending(category_groups: list) -> dict:
+    return summarize_totals(
+        {group['_id']: group['total'] for group in category_groups},
+        sum(group['night'] for group in category_groups),
+        sum(group['count'] for group in category_groups)
+    )
+
+
+def summarize_totals(category_totals: dict, night_spending: float, transactions_count: int) -> dict:
+    print(f"🔍 Найдено транзакций: {transactions_count}")
+
+    if transactions_count == 0:
+        print("⚠️ Нет транзакций для анализа")
+        return None
+
+    total_expenses = sum(category_totals.values())
+
+    print(f"💰 Общая сумма расходов: {total_expenses:,.0f}₸")
+    print(f"📊 Категории: {category_totals}")
+
+    if category_totals:
+        top_category = max(category_totals.items(), key=lambda x: x[1])
+    else:
+        top_category = (DEFAULT_CATEGORY, 0)
+
+    result = {
+        "total_expenses": total_expenses,
+        "categories": category_totals,
+        "top_category": top_category[0],
+        "top_category_amount": top_category[1],
+        "night_spending": night_spending,
+        "night_spending_percentage": (night_spending / total_expenses * 100) if total_expenses > 0 else 0
+    }
+
+    print(f"✅ Анализ завершен успешно")
+    print(f"📈 Результат: {result}")
+    return result
+
+
 def generate_personalized_recommendations(user_id: str, analysis: dict, user_goals: list) -> str:
     if not analysis:
         return ""
@@ -574,35 +952,81 @@ def generate_personalized_recommendations(user_id: str, analysis: dict, user_goa
     return "\n\n".join(recommendations) if recommendations else ""
 
 
+def period_start(period: str) -> datetime:
+    return datetime.utcnow() - timedelta(days=PERIOD_DAYS.get(period, 30))
+
+
+TRANSACTIONS_PAGE_SIZE = 100
+TRANSACTIONS_MAX_PAGE_SIZE = 500
+TRANSACTION_FIELDS = {"type": 1, "amount": 1, "description": 1, "category": 1, "createdAt": 1}
+TRANSACTIONS_SORT = [("createdAt", -1), ("_id", -1)]
+EPOCH = datetime(1970, 1, 1)
+
+
+def transactions_cursor(transaction: dict) -> str:
+    """Курсор следующей страницы: '<createdAt в мс>_<_id>' последней отданной транзакции."""
+    millis = (transaction['createdAt'] - EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}_{transaction['_id']}"
+
+
+def parse_transactions_cursor(cursor: str) -> tuple:
+    millis, _, oid = cursor.partition('_')
+    return EPOCH + timedelta(milliseconds=int(millis)), ObjectId(oid)
+
+
+def transactions_page_query(user_id: str, period: str, before: str = None) -> dict:
+    """Фильтр страницы транзакций; before — курсор из заголовка X-Next-Cursor (ValueError, если он битый)."""
+    query = {"userId": ObjectId(user_id), "createdAt": {"$gte": period_start(period)}}
+    if before:
+        try:
+            before_date, before_id = parse_transactions_cursor(before)
+        except Exception:
+            raise ValueError("Некорректный параметр before")
+        query["$or"] = [
+            {"createdAt": {"$lt": before_date}},
+            {"createdAt": before_date, "_id": {"$lt": before_id}},
+        ]
+    return query
+
+
+def page_limit(value) -> int:
+    return max(1, min(value or TRANSACTIONS_PAGE_SIZE, TRANSACTIONS_MAX_PAGE_SIZE))
+
+
+def stream_json_array(documents):
+    """Отдает JSON-массив по одному документу, не собирая весь ответ в одну строку."""
+    yield "["
+    for index, document in enumerate(documents):
+        yield ("," if index else "") + dumps(document)
+    yield "]"
+
+
+def next_cursor_headers(page: list, limit: int) -> dict:
+    return {"X-Next-Cursor": transactions_cursor(page[-1])} if len(page) == limit else {}
+
+
 @app.route('/api/transactions', methods=['GET'])
 def get_transactions():
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
     try:
-        user_id = session['user_id']
-        period = request.args.get('period', 'month')
-
-        now = datetime.utcnow()
-        if period == 'week':
-            start_date = now - timedelta(days=7)
-        elif period == 'year':
-            start_date = now - timedelta(days=365)
-        else:
-            start_date = now - timedelta(days=30)
-
-        transactions = list(db.transactions.find({
-            "userId": ObjectId(user_id),
-            "createdAt": {"$gte": start_date}
-        }).sort("createdAt", -1))
+        limit = page_limit(request.args.get('limit', type=int))
+        query = transactions_page_query(
+            session['user_id'], request.args.get('period', 'month'), request.args.get('before')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        return dumps(transactions), 200, {'Content-Type': 'application/json'}
+    try:
+        page = list(db.transactions.find(query, TRANSACTION_FIELDS).sort(TRANSACTIONS_SORT).limit(limit))
+        return Response(stream_json_array(page), status=200, content_type='application/json',
+                        headers=next_cursor_headers(page, limit))
     except Exception as e:
         print(f"Ошибка получения транзакций: {e}")
         return jsonify({"error": str(e)}), 500
 
 
-
 @app.route('/api/analytics', methods=['GET'])
 def get_analytics():
     if 'user_id' not in session:
@@ -612,7 +1036,7 @@ def get_analytics():
         user_id = session['user_id']
         print(f"🔍 Запрос аналитики для пользователя: {user_id}")
 
-        analysis = analyze_spending_habits(user_id)
+        analysis = analyze_spending_habits(user_id, PERIOD_DAYS.get(request.args.get('period'), 30))
 
         if not analysis:
             print("⚠️ Недостаточно данных для анализа")
@@ -660,6 +1084,8 @@ def add_transaction():
         }
 
         result = db.transactions.insert_one(new_transaction)
+        record_spending_safely(db, [new_transaction])
+        invalidate_user_context(user_id)
 
         return jsonify({
             "success": True,
@@ -670,6 +1096,54 @@ def add_transaction():
         return jsonify({"error": str(e)}), 500
 
 
+MAX_IMPORT_ROWS = int(os.getenv("MAX_IMPORT_ROWS", 100000))
+
+
+@app.route('/api/transactions/import', methods=['POST'])
+def import_transactions_route():
+    """
+    Импорт выписки: файл в поле 'file' (multipart) или тело запроса.
+    Формат — ?format=csv|jsonl|json, иначе по расширению файла / Content-Type.
+    """
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    user_id = session['user_id']
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        import_format = detect_import_format(upload.filename, upload.content_type, request.args.get('format'))
+    else:
+        stream = request.stream
+        import_format = detect_import_format(None, request.content_type, request.args.get('format'))
+
+    if import_format not in ('csv', 'jsonl', 'json'):
+        return jsonify({"error": f"Неподдерживаемый формат импорта: {import_format}"}), 400
+
+    try:
+        print(f"📥 Импорт транзакций ({import_format}) для пользователя: {user_id}")
+        started_at = time.monotonic()
+        report = import_transactions(
+            db, iter_import_rows(stream, import_format), ObjectId(user_id), categorize_transaction,
+            on_inserted=lambda documents: record_spending_safely(db, documents),
+            known_categories=KNOWN_CATEGORIES,
+            max_rows=MAX_IMPORT_ROWS
+        )
+        invalidate_user_context(user_id)
+        print(f"✅ Импортировано: {report.imported}, с ошибками: {report.failed} "
+              f"за {time.monotonic() - started_at:.2f}с")
+        if report.read_error:
+            print(f"⚠️ Импорт прерван: {report.read_error}")
+        # Файл не читается с самого начала — ничего не записано, отчет отдается с 400
+        status = 400 if report.read_error and not report.imported and not report.failed else 200
+        return jsonify(report.to_dict()), status
+    except Exception as e:
+        print(f"❌ Ошибка импорта транзакций: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/api/generate-demo-data', methods=['POST'])
 def generate_demo_data():
     if 'user_id' not in session:
@@ -680,6 +1154,7 @@ def generate_demo_data():
         print(f"🎲 Генерация демо-данных для пользователя: {user_id}")
 
         delete_result = db.transactions.delete_many({"userId": ObjectId(user_id)})
+        delete_user_spending(db, user_id)
         print(f"🗑️ Удалено старых транзакций: {delete_result.deleted_count}")
 
         demo_transactions = [
@@ -722,6 +1197,10 @@ def generate_demo_data():
             })
 
         result = db.transactions.insert_many(transactions_to_insert)
+        if record_spending_safely(db, transactions_to_insert):
+            # Старые транзакции удалены — агрегаты содержат всю историю пользователя
+            mark_spending_complete(db, user_id)
+        invalidate_user_context(user_id)
         print(f"✅ Вставлено транзакций: {len(result.inserted_ids)}")
 
         return jsonify({
@@ -768,7 +1247,13 @@ def register():
             "preferences": {"notifications": {"email": True, "push": False}},
             "createdAt": datetime.utcnow()
         }
-        db.users.insert_one(new_user)
+        try:
+            result = db.users.insert_one(new_user)
+        except DuplicateKeyError:
+            return render_template('register.html', error="Пользователь с таким email уже существует")
+        invalidate_user_context(result.inserted_id)
+        # У нового пользователя нет транзакций до агрегатов
+        mark_spending_complete(db, result.inserted_id)
         return redirect(url_for('login'))
     return render_template('register.html')
 
@@ -856,6 +1341,31 @@ def chat():
         }), 200
 
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    if 'user_id' not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    user_id = session['user_id']
+    data = request.get_json()
+    user_message = data.get("message", "")
+
+    if not user_message:
+        return jsonify({
+            "reply": "Пожалуйста, напишите что-нибудь.",
+            "open_bank_site": False,
+            "bank_url": None
+        })
+
+    print(f"💬 Получено сообщение (stream) от {user_id}: {user_message}")
+
+    return Response(
+        stream_with_context(stream_rag_response(user_id, user_message)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/transcribe', methods=['POST'])
 def transcribe_audio():
     if 'audio' not in request.files: return jsonify({"error": "Аудиофайл не найден"}), 400
@@ -874,6 +1384,40 @@ def transcribe_audio():
             os.remove(temp_audio_path)
 
 
+def is_admin_request() -> bool:
+    admin_token = os.getenv("ADMIN_TOKEN")
+    provided = request.headers.get("X-Admin-Token", "")
+    return bool(admin_token) and hmac.compare_digest(provided.encode("utf-8"), admin_token.encode("utf-8"))
+
+
+@app.route('/api/admin/vector-index', methods=['GET'])
+def vector_index_status():
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+
+    return jsonify({
+        "indexes": vector_indexes.status(),
+        "embedding_cache": embedding_cache.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None
+    }), 200
+
+
+@app.route('/api/admin/vector-index/reload', methods=['POST'])
+def vector_index_reload():
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+
+    reloaded = load_vector_databases(force=request.args.get('force') == '1')
+    return jsonify({"reloaded": reloaded, "indexes": vector_indexes.status()}), 200
+
+
+@app.route('/api/admin/pools', methods=['GET'])
+def pool_status():
+    if not is_admin_request():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(pool_metrics_snapshot()), 200
+
+
 @app.route('/api/accounts')
 def get_accounts():
     if 'user_id' not in session:
@@ -935,6 +1479,7 @@ def add_goal():
         }
 
         result = db.goals.insert_one(new_goal)
+        invalidate_user_context(user_id)
         print(f"✓ Цель успешно добавлена: {result.inserted_id}")
 
         return jsonify({
@@ -946,7 +1491,54 @@ def add_goal():
         print(f"✗ Ошибка при добавлении цели: {e}")
         return jsonify({"error": str(e)}), 500
 
+_startup_lock = threading.Lock()
+_started = False
+
+
+def startup():
+    """
+    Разовая подготовка: коллекции, индексы MongoDB, векторные базы.
+    Под gunicorn --preload выполняется один раз в мастере: mmap-индексы делятся
+    между воркерами, а соединение мастера закрывается до fork.
+    """
+    global _started
+    with _startup_lock:
+        if _started:
+            return
+        if "transactions" not in db.list_collection_names():
+            db.create_collection("transactions")
+            print("✓ Коллекция transactions создана")
+        if os.getenv("BOOTSTRAP_INDEXES", "1") == "1":
+            ensure_indexes(db)
+        print(f"✓ MongoDB подключена успешно")
+        print(f"✓ База данных: {DB_NAME}")
+
+        load_vector_databases()
+        mongo_client.close()
+        db.reset()
+        _started = True
+        print(f"✓ Все системы готовы к работе!\n")
+
+
+@app.before_request
+def ensure_started():
+    # Без --preload и create_app() подготовка выполняется при первом запросе воркера
+    if not _started:
+        startup()
+
+
+def create_app():
+    """Фабрика приложения: gunicorn --preload 'main:create_app()'."""
+    startup()
+    return app
+
+
+IMPORT_TIME = time.perf_counter() - IMPORT_STARTED_AT
+IMPORT_TIME_BUDGET = float(os.getenv("IMPORT_TIME_BUDGET", 1.0))
+if IMPORT_TIME > IMPORT_TIME_BUDGET:
+    print(f"⚠️ Импорт main.py занял {IMPORT_TIME * 1000:.0f} мс (бюджет {IMPORT_TIME_BUDGET * 1000:.0f} мс)")
+
+
 if __name__ == '__main__':
-    load_vector_databases()
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,123 @@
+"""
+HTTP-слой клиентов OpenAI: лимиты пула (max in-flight), keep-alive, таймауты
+и учет запросов в HttpPoolMetrics. Импортируется лениво вместе с openai.
+"""
+
+import httpx
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+
+
+class _MeteredStream(httpx.SyncByteStream):
+    """Запрос считается завершенным, когда тело ответа дочитано и закрыто (важно для stream=True)."""
+
+    def __init__(self, stream, metrics, started_at, status_code):
+        self._stream = stream
+        self._metrics = metrics
+        self._started_at = started_at
+        self._status_code = status_code
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._stream.close()
+        finally:
+            self._metrics.finish(self._started_at, self._status_code)
+
+
+class _MeteredAsyncStream(httpx.AsyncByteStream):
+    def __init__(self, stream, metrics, started_at, status_code):
+        self._stream = stream
+        self._metrics = metrics
+        self._started_at = started_at
+        self._status_code = status_code
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._stream.aclose()
+        finally:
+            self._metrics.finish(self._started_at, self._status_code)
+
+
+class MeteredTransport(httpx.BaseTransport):
+    def __init__(self, transport, metrics):
+        self._transport = transport
+        self._metrics = metrics
+
+    def handle_request(self, request):
+        started_at = self._metrics.start()
+        try:
+            response = self._transport.handle_request(request)
+        except Exception:
+            self._metrics.finish(started_at, error=True)
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_MeteredStream(response.stream, self._metrics, started_at, response.status_code),
+            extensions=response.extensions,
+        )
+
+    def close(self):
+        self._transport.close()
+
+
+class MeteredAsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, transport, metrics):
+        self._transport = transport
+        self._metrics = metrics
+
+    async def handle_async_request(self, request):
+        started_at = self._metrics.start()
+        try:
+            response = await self._transport.handle_async_request(request)
+        except Exception:
+            self._metrics.finish(started_at, error=True)
+            raise
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_MeteredAsyncStream(response.stream, self._metrics, started_at, response.status_code),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+def openai_client_kwargs(settings: dict, metrics, asynchronous: bool = False) -> dict:
+    """
+    Аргументы для OpenAI/AsyncOpenAI: таймауты передаются и самому клиенту —
+    иначе SDK подставляет свой таймаут по умолчанию (10 минут) в каждый запрос.
+    Лимит max_connections пула httpx ограничивает число запросов в полете; остальные
+    ждут свободного соединения не дольше pool_timeout.
+    """
+    metrics.max_in_flight = settings["max_in_flight"]
+    timeout = httpx.Timeout(
+        settings["timeout"], connect=settings["connect_timeout"], pool=settings["pool_timeout"]
+    )
+    limits = httpx.Limits(
+        max_connections=settings["max_in_flight"],
+        max_keepalive_connections=settings["max_keepalive"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+    if asynchronous:
+        transport = MeteredAsyncTransport(httpx.AsyncHTTPTransport(limits=limits), metrics)
+        http_client = DefaultAsyncHttpxClient(transport=transport, timeout=timeout)
+    else:
+        transport = MeteredTransport(httpx.HTTPTransport(limits=limits), metrics)
+        http_client = DefaultHttpxClient(transport=transport, timeout=timeout)
+    return {"timeout": timeout, "max_retries": settings["max_retries"], "http_client": http_client}
@@ -1,8 +1,18 @@
+import argparse
+import hashlib
 import json
 import os
+import random
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 import time
+from chunking import CHUNKER_VERSION, chunk_sources, near_duplicate_mask
+from embeddings import embedding_id, embedding_request_kwargs, embedding_settings
+from vector_index import (atomic_write, has_vector_store, load_vector_records, read_store_metadata,
+                          remove_vector_store, save_vector_store)
 
 # --- 1. НАСТРОЙКА API-КЛИЕНТА ---
 load_dotenv()
@@ -12,7 +22,8 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
     raise ValueError("❌ OPENAI_API_KEY не найден в .env файле!")
 
-openai_client = OpenAI(api_key=openai_api_key)
+# Повторы делаем сами (с учетом заголовков rate limit), поэтому встроенные отключены
+openai_client = OpenAI(api_key=openai_api_key, max_retries=0)
 print("✓ OpenAI API инициализирован")
 
 # --- 2. КОНФИГУРАЦИЯ ЯЗЫКОВ ---
@@ -31,6 +42,17 @@ LANGUAGES = [
     }
 ]
 
+# Модель и размерность из EMBEDDING_MODEL / EMBEDDING_DIMENSIONS (или --model / --dimensions);
+# main.py должен использовать те же настройки — иначе он откажется загружать базу
+EMBEDDING = embedding_settings()
+EMBEDDING_BATCH_SIZE = 64        # чанков в одном запросе embeddings.create
+MAX_CONCURRENT_BATCHES = 4       # одновременных запросов ко всем языкам сразу
+MAX_RETRIES = 6
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100              # перекрытие целыми предложениями, только внутри сплошного текста
+ANN_AUTO_THRESHOLD = 20000       # с этого числа чанков --ann auto строит IVF-индекс
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
 
 # --- 3. ФУНКЦИИ ДЛЯ ОБРАБОТКИ ДАННЫХ ---
 
@@ -45,106 +67,398 @@ def load_knowledge_base(filename):
         return None
 
 
-def get_embedding(text_chunk, model="text-embedding-3-small"):
-    """Получает вектор для одного фрагмента текста с помощью API."""
+def parse_reset_header(value):
+    """Переводит значение вида '1s', '250ms', '6m0s' или '2.5' в секунды."""
+    if not value:
+        return None
     try:
-        text_chunk = text_chunk.replace("\n", " ")
-        response = openai_client.embeddings.create(input=[text_chunk], model=model)
-        return response.data[0].embedding
-    except Exception as e:
-        print(f"  ❌ Ошибка при векторизации: {e}")
-        time.sleep(5)
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"([\d.]+)(ms|s|m|h)", value)
+    if not parts:
         return None
+    return sum(float(number) * units[unit] for number, unit in parts)
 
 
-def chunk_text(text, chunk_size=1000, chunk_overlap=200):
-    """Разбивает большой текст на пересекающиеся чанки."""
-    if len(text) <= chunk_size:
-        return [text]
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + chunk_size
-        chunks.append(text[start:end])
-        start += chunk_size - chunk_overlap
-    return chunks
+def retry_delay(error, attempt):
+    """
+    Пауза перед повтором: берем подсказку сервера (retry-after / x-ratelimit-reset-*),
+    иначе — экспоненциальный backoff с джиттером.
+    """
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    for header in ("retry-after", "x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        delay = parse_reset_header(headers.get(header))
+        if delay is not None:
+            return delay
+    return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+
+def embed_batch(texts, embedding=EMBEDDING, stats=None):
+    """Векторизует список текстов одним запросом с повторами при rate limit и сетевых ошибках."""
+    inputs = [text.replace("\n", " ") for text in texts]
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = openai_client.embeddings.create(input=inputs, **embedding_request_kwargs(embedding))
+            if stats is not None and response.usage is not None:
+                stats.add(tokens=response.usage.total_tokens)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = retry_delay(e, attempt)
+            if stats is not None:
+                stats.add(retries=1)
+            print(f"  ⏳ {type(e).__name__}: повтор {attempt + 1}/{MAX_RETRIES} через {delay:.1f}с")
+            time.sleep(delay)
+
+
+class EmbeddingStats:
+    """Потокобезопасные счетчики для итогового отчета о векторизации."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.chunks = 0
+        self.failed_chunks = 0
+        self.batches = 0
+        self.retries = 0
+        self.tokens = 0
+
+    def add(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def report(self):
+        elapsed = time.monotonic() - self.started_at
+        print("\n" + "=" * 60)
+        print("📈 ОТЧЕТ О ВЕКТОРИЗАЦИИ")
+        print(f"   Чанков векторизовано: {self.chunks}")
+        print(f"   Чанков с ошибкой:     {self.failed_chunks}")
+        print(f"   Запросов (батчей):    {self.batches}, повторов: {self.retries}")
+        print(f"   Токенов:              {self.tokens}")
+        print(f"   Время:                {elapsed:.1f}с")
+        if elapsed > 0:
+            print(f"   Пропускная способность: {self.chunks / elapsed:.1f} чанков/с, "
+                  f"{self.tokens / elapsed:.0f} токенов/с")
+        print("=" * 60)
+
+
+def chunker_params():
+    """Параметры чанкера, влияющие на содержимое чанков (входят в хэш)."""
+    return {"chunker": CHUNKER_VERSION, "chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP}
+
+
+def chunk_hash(text, embedding=EMBEDDING):
+    """Хэш чанка: текст + модель (и размерность) эмбеддингов + параметры чанкера."""
+    payload = json.dumps([embedding_id(embedding), chunker_params(), text], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_existing_vectors(output_file):
+    """
+    Загружает уже посчитанные векторы текущей базы: {hash: vector}.
+    Записи без сохраненного хэша (старый формат) не переиспользуются.
+    """
+    if has_vector_store(output_file):
+        matrix, metadata = load_vector_records(output_file, mmap=False)
+        return {
+            record["hash"]: matrix[i].tolist()
+            for i, record in enumerate(metadata["records"]) if record.get("hash")
+        }
+    if os.path.exists(output_file):
+        with open(output_file, 'r', encoding='utf-8') as f:
+            return {record["hash"]: record["vector"] for record in json.load(f) if record.get("hash")}
+    return {}
+
+
+def resolve_ann(ann, count):
+    """auto -> ivf для больших баз (ANN_AUTO_THRESHOLD+ чанков), иначе точный поиск."""
+    if ann == "auto":
+        return "ivf" if count >= ANN_AUTO_THRESHOLD else "none"
+    return ann
+
+
+def stored_output_matches(output_file, output_format, store_options, count):
+    """
+    Совпадает ли то, что уже лежит на диске, с запрошенным выводом: нужные файлы
+    есть, а бинарное хранилище собрано с тем же dtype и тем же ANN-индексом.
+    """
+    if output_format in ("json", "both") and not os.path.exists(output_file):
+        return False
+    if output_format == "json":
+        return not has_vector_store(output_file)
+    if not has_vector_store(output_file):
+        return False
+    options = store_options or {}
+    metadata = read_store_metadata(output_file)
+    stored_dtype = (metadata.get("quantized") or {}).get("dtype", "float32")
+    stored_ann = metadata.get("ann") or {}
+    ann = resolve_ann(options.get("ann", "auto"), count)
+    if stored_dtype != options.get("dtype", "float32") or stored_ann.get("type", "none") != ann:
+        return False
+    return ann != "ivf" or options.get("ann_lists") in (None, stored_ann.get("lists"))
+
+
+def save_vector_database(vector_database, output_file, output_format="both", store_options=None):
+    """
+    Сохраняет векторную базу на диск.
+    json — исходный формат (vector_database.json),
+    npy  — бинарная float32-матрица + сайдкар с content/source для mmap-загрузки в main.py
+           (и IVF-индекс / квантованная копия матрицы, см. ann_index.py и quantization.py).
+    store_options — ann, ann_lists и dtype для save_vector_store.
+    При записи только json прежнее бинарное хранилище удаляется: main.py предпочитает
+    его JSON-файлу и иначе продолжал бы отдавать старые векторы.
+    """
+    saved_files = []
+    if output_format in ("json", "both"):
+        atomic_write(output_file, lambda f: json.dump(vector_database, f, ensure_ascii=False), "w")
+        saved_files.append(output_file)
+    if output_format == "json":
+        for path in remove_vector_store(output_file):
+            print(f"🗑️  Удалено устаревшее бинарное хранилище: {path}")
+    if output_format in ("npy", "both"):
+        options = dict(store_options or {})
+        options["ann"] = resolve_ann(options.get("ann", "auto"), len(vector_database))
+        if options["ann"] == "ivf":
+            print(f"🧭 Построение IVF-индекса для {len(vector_database)} векторов...")
+        saved_files.extend(save_vector_store(
+            output_file, [item["vector"] for item in vector_database], vector_database, **options
+        ))
+    return saved_files
+
+
+def convert_json_to_store(lang_config, store_options=None):
+    """Конвертирует уже готовый vector_database*.json в бинарный формат без обращения к API."""
+    output_file = lang_config["output_file"]
+    vector_database = load_knowledge_base(output_file)
+    if not vector_database:
+        return
+    saved_files = save_vector_database(vector_database, output_file, "npy", store_options)
+    print(f"✅ {lang_config['name']}: сконвертировано векторов: {len(vector_database)}")
+    for path in saved_files:
+        print(f"📦 Файл сохранен: {path}")
 
 
 # --- 4. ОСНОВНАЯ ЛОГИКА ОБРАБОТКИ ---
 
-def process_language_files(lang_config):
+def collect_language_chunks(lang_config, embedding=EMBEDDING, workers=None):
     """
-    Выполняет полный цикл обработки для одного языка:
-    загрузка -> чанкинг -> векторизация -> сохранение.
+    Загружает базу знаний языка и разбивает ее на чанки (без векторов):
+    источники делятся структурным чанкером в пуле процессов, затем почти
+    одинаковые чанки (повторяющиеся блоки страниц) отбрасываются.
     """
     input_file = lang_config["input_file"]
-    output_file = lang_config["output_file"]
     lang_name = lang_config["name"]
 
     print("\n" + "=" * 60)
-    print(f"НАЧАТА ОБРАБОТКА ДЛЯ ЯЗЫКА: {lang_name.upper()}")
+    print(f"ПОДГОТОВКА ЧАНКОВ ДЛЯ ЯЗЫКА: {lang_name.upper()}")
     print(f"Входной файл: {input_file}")
-    print("=" * 60 + "\n")
+    print("=" * 60)
 
     knowledge_data = load_knowledge_base(input_file)
     if not knowledge_data:
-        return  # Переходим к следующему языку, если файл не найден
+        return None  # Переходим к следующему языку, если файл не найден
 
-    vector_database = []
-    total_chunks = 0
+    chunked = chunk_sources([entry["content"] for entry in knowledge_data], CHUNK_SIZE, CHUNK_OVERLAP, workers)
+    chunks = [(entry["source_url"], chunk) for entry, entry_chunks in zip(knowledge_data, chunked)
+              for chunk in entry_chunks]
+    keep = near_duplicate_mask([chunk for _, chunk in chunks])
+    records = [
+        {"source": source, "content": chunk, "hash": chunk_hash(chunk, embedding)}
+        for (source, chunk), kept in zip(chunks, keep) if kept
+    ]
 
-    print(f"📚 Найдено источников: {len(knowledge_data)}")
-    print("🔄 Начинаю обработку...\n")
+    print(f"📚 Источников: {len(knowledge_data)}, чанков: {len(records)}, "
+          f"почти одинаковых отброшено: {len(chunks) - len(records)}")
+    return records
 
-    for idx, entry in enumerate(knowledge_data, 1):
-        source = entry["source_url"]
-        content = entry["content"]
-        chunks = chunk_text(content)
 
-        print(f"[{idx}/{len(knowledge_data)}] Обработка: {source}")
-        print(f"           Чанков: {len(chunks)}")
+def embed_records(jobs, batch_size=EMBEDDING_BATCH_SIZE, concurrency=MAX_CONCURRENT_BATCHES, embedding=EMBEDDING):
+    """
+    Векторизует чанки всех языков батчами, параллельно выполняя до `concurrency` запросов.
+    jobs — {название языка: [записи]}; векторы дописываются в записи на месте.
+    """
+    stats = EmbeddingStats()
+    batches = [
+        (lang_name, records[start:start + batch_size])
+        for lang_name, records in jobs.items()
+        for start in range(0, len(records), batch_size)
+    ]
+    print(f"\n🔄 Векторизация: {sum(len(r) for r in jobs.values())} чанков, "
+          f"{len(batches)} батчей по {batch_size}, параллельно {concurrency}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(embed_batch, [record["content"] for record in batch], embedding, stats): (lang_name, batch)
+            for lang_name, batch in batches
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            lang_name, batch = futures[future]
+            try:
+                vectors = future.result()
+            except Exception as e:
+                stats.add(failed_chunks=len(batch), batches=1)
+                print(f"  ❌ [{done}/{len(batches)}] {lang_name}: батч из {len(batch)} чанков не векторизован: {e}")
+                continue
+            for record, vector in zip(batch, vectors):
+                record["vector"] = vector
+            stats.add(chunks=len(batch), batches=1)
+            print(f"  ✓ [{done}/{len(batches)}] {lang_name}: +{len(batch)} векторов")
+
+    return stats
+
+
+def save_language_results(lang_config, records, output_format="both", store_options=None):
+    lang_name = lang_config["name"]
+    vector_database = [record for record in records if "vector" in record]
+    failed = len(records) - len(vector_database)
 
-        for i, chunk in enumerate(chunks):
-            print(f"           └─ Векторизация {i + 1}/{len(chunks)}...", end=" ")
-            vector = get_embedding(chunk)
+    if not vector_database:
+        print(f"\n❌ Не удалось создать векторы для {lang_name}. Файл не будет сохранен.")
+        return
 
-            if vector:
-                vector_database.append({
-                    "source": source,
-                    "content": chunk,
-                    "vector": vector
-                })
-                total_chunks += 1
-                print("✓")
-            else:
-                print("❌")
+    saved_files = save_vector_database(vector_database, lang_config["output_file"], output_format, store_options)
 
-            time.sleep(0.5)
+    print(f"\n✅ ОБРАБОТКА ДЛЯ '{lang_name}' ЗАВЕРШЕНА!")
+    for path in saved_files:
+        print(f"📦 Файл сохранен: {path}")
+    print(f"📊 Всего векторов: {len(vector_database)}")
+    if failed:
+        print(f"⚠️ Пропущено чанков из-за ошибок API: {failed}")
 
-        print()
 
-    if not vector_database:
-        print(f"\n❌ Не удалось создать векторы для {lang_name}. Файл не будет сохранен.")
+def reuse_existing_vectors(lang_config, records):
+    """
+    Инкрементальный режим: переносит векторы неизменившихся чанков из текущей базы.
+    Возвращает (записи без векторов, чанки не изменились).
+    """
+    existing = load_existing_vectors(lang_config["output_file"])
+    new_hashes = {record["hash"] for record in records}
+    for record in records:
+        if record["hash"] in existing:
+            record["vector"] = existing[record["hash"]]
+
+    pending = [record for record in records if "vector" not in record]
+    removed = len(set(existing) - new_hashes)
+    print(f"♻️  {lang_config['name']}: переиспользовано {len(records) - len(pending)}, "
+          f"новых/измененных {len(pending)}, удалено {removed}")
+    return pending, not pending and not removed and len(existing) == len(records)
+
+
+def process_languages(lang_configs, output_format="both", batch_size=EMBEDDING_BATCH_SIZE,
+                      concurrency=MAX_CONCURRENT_BATCHES, incremental=False, store_options=None,
+                      embedding=EMBEDDING, workers=None):
+    """
+    Выполняет полный цикл обработки для всех языков:
+    загрузка -> чанкинг -> (переиспользование векторов) -> батчевая векторизация -> сохранение.
+    """
+    store_options = dict(store_options or {}, embedding=embedding)
+    all_records = {}
+    jobs = {}
+    for lang_config in lang_configs:
+        records = collect_language_chunks(lang_config, embedding, workers)
+        if not records:
+            continue
+        if incremental:
+            pending, unchanged = reuse_existing_vectors(lang_config, records)
+            # Те же чанки, но другой --format/--dtype/--ann — база все равно пересохраняется
+            if unchanged and stored_output_matches(lang_config["output_file"], output_format, store_options,
+                                                   len(records)):
+                print(f"✓ {lang_config['name']}: изменений нет, база не перезаписывается")
+                continue
+        else:
+            pending = records
+        all_records[lang_config["name"]] = records
+        if pending:
+            jobs[lang_config["name"]] = pending
+
+    if not all_records:
         return
 
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(vector_database, f, ensure_ascii=False, indent=4)
+    print(f"🧬 Модель эмбеддингов: {embedding_id(embedding)}")
+    stats = embed_records(jobs, batch_size, concurrency, embedding)
+
+    for lang_config in lang_configs:
+        if lang_config["name"] in all_records:
+            save_language_results(lang_config, all_records[lang_config["name"]], output_format, store_options)
 
-    print(f"✅ ОБРАБОТКА ДЛЯ '{lang_name}' ЗАВЕРШЕНА!")
-    print(f"📦 Файл сохранен: {output_file}")
-    print(f"📊 Всего векторов: {total_chunks}")
+    stats.report()
 
 
 # --- 5. ЗАПУСК СКРИПТА ---
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Подготовка векторных баз данных")
+    parser.add_argument(
+        "--format", choices=["json", "npy", "both"], default="both",
+        help="Формат сохранения: json, бинарный npy (+ .meta.json) или оба"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=EMBEDDING_BATCH_SIZE,
+        help="Количество чанков в одном запросе к API эмбеддингов"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=MAX_CONCURRENT_BATCHES,
+        help="Максимальное число одновременных запросов к API"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="Векторизовать только новые/измененные чанки, переиспользуя векторы из текущей базы"
+    )
+    parser.add_argument(
+        "--convert", action="store_true",
+        help="Только сконвертировать существующие vector_database*.json в бинарный формат"
+    )
+    parser.add_argument(
+        "--ann", choices=["none", "ivf", "auto"], default="auto",
+        help=f"ANN-индекс для бинарного формата: auto строит IVF от {ANN_AUTO_THRESHOLD} чанков"
+    )
+    parser.add_argument(
+        "--ann-lists", type=int,
+        help="Количество списков IVF (по умолчанию ~4·√N)"
+    )
+    parser.add_argument(
+        "--dtype", choices=["float32", "float16", "int8"], default="float32",
+        help="Тип матрицы для поиска в main.py: float16/int8 сохраняются рядом с float32 (для переранжирования)"
+    )
+    parser.add_argument(
+        "--model", default=EMBEDDING["model"],
+        help="Модель эмбеддингов (по умолчанию EMBEDDING_MODEL или text-embedding-3-small)"
+    )
+    parser.add_argument(
+        "--dimensions", type=int, default=EMBEDDING["dimensions"],
+        help="Размерность эмбеддингов text-embedding-3 (по умолчанию EMBEDDING_DIMENSIONS или полная)"
+    )
+    parser.add_argument(
+        "--workers", type=int,
+        help="Процессов для чанкинга источников (по умолчанию — число CPU)"
+    )
+    return parser.parse_args()
+
+
 def main():
     """Главная функция: запускает обработку для всех языков, указанных в LANGUAGES."""
+    args = parse_args()
+
     print("\n" + "#" * 60)
     print("ЗАПУСК СКРИПТА ПОДГОТОВКИ ВЕКТОРНЫХ БАЗ ДАННЫХ")
     print("#" * 60)
 
-    for lang_config in LANGUAGES:
-        process_language_files(lang_config)
+    embedding = embedding_settings(args.model, args.dimensions)
+    store_options = {"ann": args.ann, "ann_lists": args.ann_lists, "dtype": args.dtype}
+    if args.convert:
+        # Модель в JSON не записана: считается, что база собрана текущими настройками
+        for lang_config in LANGUAGES:
+            convert_json_to_store(lang_config, dict(store_options, embedding=embedding))
+    else:
+        process_languages(LANGUAGES, args.format, args.batch_size, args.concurrency, args.incremental,
+                          store_options, embedding, args.workers)
 
     print("\n" + "=" * 60)
     print("🎉 ВСЕ ОПЕРАЦИИ ЗАВЕРШЕНЫ!")
@@ -0,0 +1,211 @@
+"""
+Предрассчитанные агрегаты расходов: один документ на пользователя и день
+в коллекции spending_daily, обновляемый через $inc при записи транзакций.
+
+Транзакции, записанные до появления агрегатов, в них не учтены. Поэтому для
+каждого пользователя в spending_coverage хранится отметка since: агрегаты
+полны для дней начиная с since. Аналитика читает агрегаты, только если отметка
+покрывает все окно, иначе считает по сырым транзакциям.
+
+Пересчет по уже существующим транзакциям: python spending_aggregates.py [--user-id <ObjectId>]
+"""
+
+import argparse
+import os
+from datetime import datetime, timedelta
+
+import certifi
+from bson import ObjectId
+from bson.decimal128 import Decimal128
+from dotenv import load_dotenv
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+COLLECTION = "spending_daily"
+COVERAGE_COLLECTION = "spending_coverage"
+# since для пользователя, все транзакции которого учтены в агрегатах
+COMPLETE_SINCE = datetime(1970, 1, 1)
+# Категория транзакций без категории — общая для категоризации, агрегатов и сырого пути
+DEFAULT_CATEGORY = 'Прочее'
+
+
+def day_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, moment.day)
+
+
+def window_start(days: int) -> datetime:
+    """Начало окна аналитики в days дней: целые сутки UTC, одинаково для агрегатов и сырых транзакций."""
+    return day_start(datetime.utcnow() - timedelta(days=days))
+
+
+def is_night_hour(hour: int) -> bool:
+    return hour >= 23 or hour < 6
+
+
+def amount_to_float(amount):
+    if isinstance(amount, Decimal128):
+        return float(amount.to_decimal())
+    if isinstance(amount, (int, float)):
+        return float(amount)
+    return None
+
+
+def category_field_name(category) -> str:
+    """Категория как имя поля документа: точка и ведущий $ в пути $inc недопустимы."""
+    if not isinstance(category, str) or not category or '.' in category or category.startswith('$'):
+        return DEFAULT_CATEGORY
+    return category
+
+
+def spending_updates(transactions: list) -> list:
+    """Готовит $inc-апсерты дневных агрегатов для расходных транзакций."""
+    increments = {}
+    for tx in transactions:
+        amount = amount_to_float(tx.get('amount'))
+        created_at = tx.get('createdAt')
+        if tx.get('type') != 'expense' or amount is None or not isinstance(created_at, datetime):
+            continue
+        key = (tx['userId'], day_start(created_at))
+        inc = increments.setdefault(key, {})
+        category_field = f"categories.{category_field_name(tx.get('category'))}"
+        inc['total'] = inc.get('total', 0) + amount
+        inc['count'] = inc.get('count', 0) + 1
+        inc[category_field] = inc.get(category_field, 0) + amount
+        if is_night_hour(created_at.hour):
+            inc['night'] = inc.get('night', 0) + amount
+
+    return [
+        UpdateOne({"userId": user_id, "day": day}, {"$inc": inc}, upsert=True)
+        for (user_id, day), inc in increments.items()
+    ]
+
+
+def record_spending(db, transactions: list):
+    """Учитывает новые транзакции в дневных агрегатах (одним bulk_write)."""
+    updates = spending_updates(transactions)
+    if updates:
+        mark_spending_started(db, {tx['userId'] for tx in transactions if tx.get('type') == 'expense'})
+        db[COLLECTION].bulk_write(updates, ordered=False)
+
+
+def record_spending_safely(db, transactions: list) -> bool:
+    """
+    Учет в агрегатах после уже сохраненной вставки: ошибка не должна превращать
+    записанные транзакции в ответ 500. Вместо этого отметка полноты сдвигается
+    за пропущенные транзакции, и аналитика считает по сырым транзакциям.
+    """
+    try:
+        record_spending(db, transactions)
+        return True
+    except Exception as e:
+        print(f"⚠️ Агрегаты расходов не обновлены: {e}")
+    try:
+        mark_spending_incomplete(db, transactions)
+    except Exception as e:
+        print(f"❌ Не удалось сбросить отметку полноты агрегатов: {e}")
+    return False
+
+
+def mark_spending_incomplete(db, transactions: list):
+    """Агрегаты не покрывают дни этих транзакций: since сдвигается не раньше завтрашнего дня."""
+    since = {}
+    tomorrow = day_start(datetime.utcnow()) + timedelta(days=1)
+    for tx in transactions:
+        created_at = tx.get('createdAt')
+        day_after = day_start(created_at) + timedelta(days=1) if isinstance(created_at, datetime) else tomorrow
+        since[tx['userId']] = max(since.get(tx['userId'], tomorrow), day_after)
+    for user_id, user_since in since.items():
+        db[COVERAGE_COLLECTION].update_one({"_id": user_id}, {"$max": {"since": user_since}}, upsert=True)
+
+
+def mark_spending_started(db, user_ids):
+    """
+    Отметка для пользователей, у которых ее еще нет: их более ранние транзакции
+    в агрегатах не учтены, поэтому полными считаются дни, начиная со следующего.
+    """
+    since = day_start(datetime.utcnow()) + timedelta(days=1)
+    for user_id in user_ids:
+        try:
+            db[COVERAGE_COLLECTION].update_one({"_id": user_id}, {"$setOnInsert": {"since": since}}, upsert=True)
+        except DuplicateKeyError:
+            # Отметку только что создал параллельный запрос
+            pass
+
+
+def mark_spending_complete(db, user_id):
+    """Все транзакции пользователя учтены в агрегатах: новый пользователь, пересчет или сброс данных."""
+    db[COVERAGE_COLLECTION].update_one({"_id": ObjectId(user_id)}, {"$set": {"since": COMPLETE_SINCE}}, upsert=True)
+
+
+def spending_coverage_query(user_id) -> dict:
+    return {"_id": ObjectId(user_id)}
+
+
+def aggregates_cover(coverage, days: int) -> bool:
+    """Покрывают ли агрегаты (документ отметки или None) все окно в days дней."""
+    if not coverage:
+        return False
+    return coverage["since"] <= window_start(days)
+
+
+def delete_user_spending(db, user_id):
+    db[COLLECTION].delete_many({"userId": ObjectId(user_id)})
+
+
+def daily_spending_query(user_id, days: int) -> dict:
+    return {"userId": ObjectId(user_id), "day": {"$gte": window_start(days)}}
+
+
+def daily_totals(daily_docs: list) -> tuple:
+    """Сводит дневные документы к (суммы по категориям, ночные траты, число транзакций)."""
+    category_totals = {}
+    night_spending = 0
+    transactions_count = 0
+    for doc in daily_docs:
+        for category, amount in doc.get('categories', {}).items():
+            category_totals[category] = category_totals.get(category, 0) + amount
+        night_spending += doc.get('night', 0)
+        transactions_count += doc.get('count', 0)
+    return category_totals, night_spending, transactions_count
+
+
+def rebuild_spending(db, user_id=None):
+    """Пересчитывает агрегаты по сырым транзакциям (для данных, записанных до их появления)."""
+    query = {"type": "expense"}
+    if user_id:
+        query["userId"] = ObjectId(user_id)
+        delete_user_spending(db, user_id)
+    else:
+        db[COLLECTION].delete_many({})
+        db[COVERAGE_COLLECTION].delete_many({})
+
+    batch = []
+    processed = 0
+    projection = {"userId": 1, "type": 1, "amount": 1, "category": 1, "createdAt": 1}
+    for tx in db.transactions.find(query, projection).batch_size(5000):
+        batch.append(tx)
+        if len(batch) == 5000:
+            record_spending(db, batch)
+            processed += len(batch)
+            batch = []
+    record_spending(db, batch)
+    processed += len(batch)
+
+    user_ids = [user_id] if user_id else db.users.distinct("_id")
+    for uid in user_ids:
+        mark_spending_complete(db, uid)
+    print(f"✓ Агрегаты пересчитаны по {processed} транзакциям, отметок полноты: {len(user_ids)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчет дневных агрегатов расходов")
+    parser.add_argument("--user-id", help="Пересчитать только для одного пользователя")
+    args = parser.parse_args()
+
+    load_dotenv()
+    mongo_client = MongoClient(os.getenv("MONGO_URI"), tlsCAFile=certifi.where())
+    rebuild_spending(mongo_client["E-commerce"], args.user_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Структурный чанкер: лимиты размера, целые пары вопрос-ответ, полнота текста, перекрытие и дедупликация."""
+
+import random
+import re
+
+import pytest
+
+from chunking import (QA_MAX_FACTOR, chunk_sources, chunk_text, near_duplicate_mask, split_long_text,
+                      split_sentences)
+
+WORDS = ["карта", "депозит", "кредит", "ставка", "банк", "шот", "несие", "онлайн", "тариф", "кешбэк"]
+
+
+def random_sentence(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 25))) + rng.choice([".", "!", "?", ""])
+
+
+def random_document(rng):
+    blocks = []
+    for _ in range(rng.randint(1, 12)):
+        kind = rng.random()
+        body = " ".join(random_sentence(rng) for _ in range(rng.randint(1, 30)))
+        if kind < 0.3:
+            blocks.append(f"Вопрос: {random_sentence(rng)} Ответ: {body}")
+        elif kind < 0.45:
+            blocks.append(f"## {random_sentence(rng)}\n{body}")
+        else:
+            blocks.append(body)
+    return "\n\n".join(blocks)
+
+
+def words(text):
+    return re.findall(r"\S+", text)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_chunks_respect_size_and_cover_text(seed):
+    rng = random.Random(seed)
+    text = random_document(rng)
+    chunk_size = rng.choice([80, 200, 500, 1000])
+    chunk_overlap = rng.choice([0, chunk_size // 5])
+
+    chunks = chunk_text(text, chunk_size, chunk_overlap)
+
+    assert all(chunk.strip() for chunk in chunks)
+    for chunk in chunks:
+        if chunk.startswith("Вопрос:"):
+            assert len(chunk) <= chunk_size * QA_MAX_FACTOR
+        else:
+            assert len(chunk) <= chunk_size
+    # Чанкер ничего не теряет: каждое слово источника есть хотя бы в одном чанке
+    assert set(words(text)) <= {word for chunk in chunks for word in words(chunk)}
+
+
+def test_qa_pairs_are_kept_whole_and_not_merged():
+    text = "Вводный абзац о банке.\n\nВопрос: Как открыть карту? Ответ: В приложении.\n" \
+           "Вопрос: Какая ставка? Ответ: 16% годовых."
+
+    chunks = chunk_text(text, chunk_size=1000)
+
+    assert chunks == [
+        "Вводный абзац о банке.",
+        "Вопрос: Как открыть карту? Ответ: В приложении.",
+        "Вопрос: Какая ставка? Ответ: 16% годовых.",
+    ]
+
+
+def test_kazakh_qa_pairs_are_recognized():
+    chunks = chunk_text("Сұрақ: Карта қалай ашамын? Жауап: Қосымшада.\nСұрақ: Несие? Жауап: Иә.")
+
+    assert chunks == ["Сұрақ: Карта қалай ашамын? Жауап: Қосымшада.", "Сұрақ: Несие? Жауап: Иә."]
+
+
+def test_long_qa_pair_repeats_question_in_every_part():
+    answer = " ".join(f"Предложение номер {i} про условия вклада." for i in range(60))
+    text = f"Вопрос: Какие условия вклада? Ответ: {answer}"
+
+    chunks = chunk_text(text, chunk_size=200, chunk_overlap=50)
+
+    assert len(chunks) > 1
+    assert all(chunk.startswith("Вопрос: Какие условия вклада? Ответ: ") for chunk in chunks)
+    assert all(len(chunk) <= 200 for chunk in chunks)
+
+
+@pytest.mark.parametrize("length, expected_chunks", [(100, 1), (101, 2)])
+def test_paragraph_at_chunk_size_edge(length, expected_chunks):
+    text = ("ааа " * 50)[:length - 1] + "а"
+
+    chunks = chunk_text(text, chunk_size=100, chunk_overlap=0)
+
+    assert len(text) == length
+    assert len(chunks) == expected_chunks
+    assert all(len(chunk) <= 100 for chunk in chunks)
+
+
+@pytest.mark.parametrize("length", [100 * QA_MAX_FACTOR, 100 * QA_MAX_FACTOR + 1])
+def test_qa_pair_at_max_factor_edge(length):
+    question = "Вопрос: Ставка? Ответ:"
+    text = f"{question} {'ссс ' * 100}"[:length - 1] + "с"
+
+    chunks = chunk_text(text, chunk_size=100, chunk_overlap=20)
+
+    assert len(text) == length
+    assert (chunks == [text]) is (length <= 100 * QA_MAX_FACTOR)
+    assert all(chunk.startswith(question) for chunk in chunks)
+
+
+def test_packing_stops_exactly_at_chunk_size():
+    first, second = "а" * 10, "б" * 9
+    # 10 + перевод строки + 9 = 20 символов — ровно chunk_size
+    assert chunk_text(f"{first}\n\n{second}", chunk_size=20) == [f"{first}\n{second}"]
+    assert chunk_text(f"{first}\n\n{second}б", chunk_size=20) == [first, second + "б"]
+
+
+def test_short_paragraphs_are_packed_together():
+    chunks = chunk_text("Первый абзац.\n\nВторой абзац.\n\nТретий абзац.", chunk_size=30)
+
+    assert chunks == ["Первый абзац.\nВторой абзац.", "Третий абзац."]
+
+
+def test_long_text_overlaps_by_whole_sentences():
+    sentences = [f"Это предложение номер {i}." for i in range(40)]
+    chunks = split_long_text(" ".join(sentences), chunk_size=120, chunk_overlap=60)
+
+    assert len(chunks) > 1
+    for previous, current in zip(chunks, chunks[1:]):
+        previous_sentences = split_sentences(previous, 120)
+        current_sentences = split_sentences(current, 120)
+        shared = next((k for k in range(len(current_sentences) - 1, 0, -1)
+                       if current_sentences[:k] == previous_sentences[-k:]), 0)
+        assert shared >= 1
+        assert len(" ".join(current_sentences[:shared])) <= 60
+    # Без перекрытий чанки дают исходную последовательность предложений
+    restored = split_sentences(chunks[0], 120)
+    for chunk in chunks[1:]:
+        chunk_sentences = split_sentences(chunk, 120)
+        restored.extend(chunk_sentences[chunk_sentences.index(restored[-1]) + 1:])
+    assert restored == sentences
+
+
+def test_glued_sentences_are_split():
+    assert split_sentences("Условия договора.Наценка 5%. Срок — год", 100) == \
+        ["Условия договора.", "Наценка 5%.", "Срок — год"]
+
+
+def test_word_longer_than_limit_is_cut():
+    pieces = split_sentences("a" * 25, 10)
+
+    assert pieces == ["a" * 10, "a" * 10, "a" * 5]
+
+
+def test_chunk_sources_parallel_matches_serial():
+    rng = random.Random(7)
+    texts = [random_document(rng) for _ in range(40)]
+
+    serial = chunk_sources(texts, chunk_size=300, chunk_overlap=60, workers=1)
+    parallel = chunk_sources(texts, chunk_size=300, chunk_overlap=60, workers=2)
+
+    assert parallel == serial
+    assert serial == [chunk_text(text, 300, 60) for text in texts]
+
+
+def test_near_duplicate_mask_drops_only_near_copies():
+    base = " ".join(f"слово{i}" for i in range(200))
+    near_copy = base.replace("слово100", "слово100!", 1).upper()
+    different = " ".join(f"другое{i}" for i in range(200))
+
+    assert near_duplicate_mask([base, near_copy, different, base]) == [True, False, True, False]
+
+
+def test_near_duplicate_mask_keeps_distinct_short_texts():
+    texts = ["Как открыть карту?", "Как закрыть карту?", "Ставка по депозиту", ""]
+
+    assert near_duplicate_mask(texts) == [True, True, True, True]
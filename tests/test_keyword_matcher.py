@@ -0,0 +1,113 @@
+"""KeywordMatcher должен совпадать с проверкой `keyword in text.lower()` для каждого слова."""
+
+import random
+
+import pytest
+
+from keyword_matcher import KeywordMatcher
+
+ALPHABET = "абвкм ё.Ә"
+
+
+def reference_find_all(keywords, text):
+    text = text.lower()
+    return {keyword.lower() for keyword in keywords if keyword.lower() in text}
+
+
+def reference_first_label(table, text, default=None):
+    text = text.lower()
+    for label, keywords in table.items():
+        if any(keyword.lower() in text for keyword in keywords):
+            return label
+    return default
+
+
+def random_word(rng, alphabet=ALPHABET, max_length=5):
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, max_length)))
+
+
+def random_table(rng):
+    # Маленький алфавит дает много общих префиксов, вложенных и перекрывающихся слов
+    return {f"label{i}": [random_word(rng) for _ in range(rng.randint(1, 4))] for i in range(rng.randint(1, 5))}
+
+
+def random_text(rng, words):
+    parts = [rng.choice(words) if words and rng.random() < 0.4 else random_word(rng, ALPHABET + "АБВКМ", 4)
+             for _ in range(rng.randint(0, 8))]
+    return "".join(parts)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_substring_reference(seed):
+    rng = random.Random(seed)
+    table = random_table(rng)
+    words = [word for keywords in table.values() for word in keywords]
+    matcher = KeywordMatcher(table)
+    for _ in range(50):
+        text = random_text(rng, words)
+        expected = reference_find_all(words, text)
+        assert matcher.find_all(text) == expected, text
+        assert matcher.count(text) == len(expected)
+        assert matcher.search(text) == bool(expected)
+        assert matcher.first_label(text, "default") == reference_first_label(table, text, "default")
+
+
+@pytest.mark.parametrize("keywords, text, expected", [
+    # Слово — префикс другого в той же позиции
+    (["карт", "карта", "карта аш"], "карта ашайын", {"карт", "карта", "карта аш"}),
+    # Совпадение начинается внутри предыдущего совпадения
+    (["абаб", "баба"], "абаба", {"абаб", "баба"}),
+    # Подстрока, а не целое слово: границы слов не учитываются
+    (["кредит"], "кредитка", {"кредит"}),
+    (["шот"], "расшотовка", {"шот"}),
+    # Слово в конце текста и повтор слова
+    (["займ"], "займ займ займ", {"займ"}),
+    # Ключевое слово с пробелом не находится через перенос строки
+    (["карта аш"], "карта\nаш", set()),
+])
+def test_find_all_targeted_cases(keywords, text, expected):
+    assert KeywordMatcher(keywords).find_all(text) == expected
+
+
+@pytest.mark.parametrize("keywords, text, expected", [
+    (["ёлка"], "ЁЛКА", True),
+    # ё и е не смешиваются — нормализацию делает вызывающий код
+    (["ёлка"], "елка", False),
+    (["қаржы"], "ҚАРЖЫ", True),
+    (["өтінім"], "Өтінім беру", True),
+    (["ҚАРЖЫ"], "қаржы", True),
+    (["beeline"], "BeeLine оплата", True),
+])
+def test_case_folding_of_cyrillic_and_kazakh(keywords, text, expected):
+    assert KeywordMatcher(keywords).search(text) is expected
+
+
+def test_same_keyword_in_two_labels_belongs_to_the_first():
+    matcher = KeywordMatcher({"Транспорт": ["такси"], "Развлечения": ["такси", "кино"]})
+    assert matcher.first_label("Такси до кино") == "Транспорт"
+    assert matcher.first_label("кино") == "Развлечения"
+    assert matcher.labels == ["Транспорт", "Развлечения"]
+
+
+def test_overlapping_keywords_are_all_counted():
+    matcher = KeywordMatcher(["как", "какой", "кой", "ой"])
+    assert matcher.find_all("Какой банк?") == {"как", "какой", "кой", "ой"}
+
+
+def test_plain_list_and_default_label():
+    matcher = KeywordMatcher(["кредит"])
+    assert matcher.first_label("Хочу КРЕДИТ") is None
+    assert matcher.first_label("депозит", default="Прочее") == "Прочее"
+    assert not matcher.search("")
+
+
+def test_regex_metacharacters_are_literal():
+    matcher = KeywordMatcher({"Одежда": ["h&m"], "Прочее": ["a.b", "(x)"]})
+    assert matcher.first_label("Магазин H&M") == "Одежда"
+    assert not matcher.search("axb")
+    assert matcher.find_all("a.b (x)") == {"a.b", "(x)"}
+
+
+def test_first_label_follows_table_order():
+    matcher = KeywordMatcher({"Продукты": ["магазин"], "Одежда": ["магазин одежды"]})
+    assert matcher.first_label("Магазин одежды Zara") == "Продукты"
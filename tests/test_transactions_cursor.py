@@ -0,0 +1,72 @@
+"""Курсорная пагинация GET /api/transactions: курсор и фильтр страницы (main.py)."""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+import main
+
+
+def make_transactions(user_oid, count, seed=0):
+    # Mongo хранит даты с точностью до миллисекунд; много совпадающих createdAt проверяют сортировку по _id
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    return [
+        {
+            "_id": ObjectId(),
+            "userId": user_oid,
+            "type": "expense",
+            "amount": 100,
+            "description": f"tx {i}",
+            "createdAt": now - timedelta(minutes=rng.randrange(30), milliseconds=rng.choice((0, 1, 999))),
+        }
+        for i in range(count)
+    ]
+
+
+def test_cursor_round_trip():
+    transaction = {"_id": ObjectId(), "createdAt": datetime(2026, 10, 1, 12, 30, 15, 123000)}
+    cursor = main.transactions_cursor(transaction)
+    assert main.parse_transactions_cursor(cursor) == (transaction["createdAt"], transaction["_id"])
+
+
+def test_cursor_before_epoch_round_trip():
+    transaction = {"_id": ObjectId(), "createdAt": datetime(1969, 12, 31, 23, 59, 59, 1000)}
+    assert main.parse_transactions_cursor(main.transactions_cursor(transaction)) == (
+        transaction["createdAt"], transaction["_id"]
+    )
+
+
+@pytest.mark.parametrize("cursor", ["_", "abc", "123", "123_not-an-oid", f"x_{ObjectId()}"])
+def test_broken_cursor_is_rejected(cursor):
+    with pytest.raises(ValueError):
+        main.transactions_page_query(str(ObjectId()), "month", cursor)
+
+
+def test_next_cursor_only_for_full_page():
+    page = make_transactions(ObjectId(), 3)
+    assert main.next_cursor_headers(page, 5) == {}
+    assert main.next_cursor_headers(page, 3) == {"X-Next-Cursor": main.transactions_cursor(page[-1])}
+
+
+@pytest.mark.parametrize("limit", [1, 7, 100])
+def test_pages_cover_all_transactions_once(limit):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.transactions
+    user_oid = ObjectId()
+    transactions = make_transactions(user_oid, 250)
+    collection.insert_many(transactions + make_transactions(ObjectId(), 20, seed=1))
+
+    seen, before = [], None
+    while True:
+        query = main.transactions_page_query(str(user_oid), "month", before)
+        page = list(collection.find(query, main.TRANSACTION_FIELDS).sort(main.TRANSACTIONS_SORT).limit(limit))
+        seen.extend(page)
+        before = main.next_cursor_headers(page, limit).get("X-Next-Cursor")
+        if before is None:
+            break
+
+    expected = sorted(transactions, key=lambda tx: (tx["createdAt"], tx["_id"]), reverse=True)
+    assert [tx["_id"] for tx in seen] == [tx["_id"] for tx in expected]
@@ -0,0 +1,243 @@
+"""
+Массовый импорт транзакций из выписки (CSV, JSON Lines или JSON-массив).
+
+Строки читаются из потока по одной, проверяются и собираются в чанки;
+запись — неупорядоченным insert_many на чанк, ошибки — построчно.
+"""
+
+import csv
+import io
+import json
+from datetime import date, datetime, time, timezone
+from decimal import Decimal, InvalidOperation
+
+from bson.decimal128 import Decimal128
+from pymongo.errors import BulkWriteError
+
+IMPORT_CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+TRANSACTION_TYPES = ('expense', 'income')
+DATETIME_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M')
+DATE_FORMATS = ('%d.%m.%Y',)
+# Время для строк выписки без времени: полдень не попадает в ночные траты (23:00-06:00)
+DATE_ONLY_TIME = time(12, 0)
+
+
+def detect_import_format(filename: str = None, content_type: str = None, explicit: str = None) -> str:
+    """Формат выписки: явный ?format=, затем расширение файла, затем Content-Type."""
+    if explicit:
+        return explicit.lower()
+    name = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if name.endswith(('.jsonl', '.ndjson')) or 'ndjson' in content_type or 'jsonl' in content_type:
+        return 'jsonl'
+    if name.endswith('.json') or 'json' in content_type:
+        return 'json'
+    return 'csv'
+
+
+def iter_import_rows(stream, import_format: str):
+    """Итерирует строки выписки как словари, не читая поток целиком (кроме JSON-массива)."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if import_format == 'csv':
+        sample = text.readline()
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.DictReader(_chain_line(sample, text), dialect=dialect)
+    elif import_format == 'jsonl':
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                # Битая строка — ошибка этой строки, а не всего импорта
+                yield ValueError(f"некорректный JSON: {e.msg}")
+    elif import_format == 'json':
+        rows = json.load(text)
+        if isinstance(rows, dict):
+            rows = rows.get('transactions', [])
+        yield from rows
+    else:
+        raise ValueError(f"Неподдерживаемый формат импорта: {import_format}")
+
+
+def _chain_line(first_line, rest):
+    yield first_line
+    yield from rest
+
+
+def parse_amount(value) -> Decimal128:
+    try:
+        amount = Decimal(str(value).replace(' ', '').replace(',', '.'))
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"некорректная сумма: {value!r}")
+    if not amount.is_finite() or amount <= 0:
+        raise ValueError(f"сумма должна быть положительным числом: {value!r}")
+    try:
+        return Decimal128(amount)
+    except Exception:
+        raise ValueError(f"сумма вне диапазона Decimal128: {value!r}")
+
+
+def parse_created_at(value, default: datetime) -> datetime:
+    """Дата операции; если в выписке только дата, время ставится в DATE_ONLY_TIME."""
+    if value in (None, ''):
+        return default
+    text = str(value).strip()
+    try:
+        return datetime.combine(date.fromisoformat(text), DATE_ONLY_TIME)
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.combine(datetime.strptime(text, date_format).date(), DATE_ONLY_TIME)
+        except ValueError:
+            continue
+    try:
+        moment = datetime.fromisoformat(text)
+    except ValueError:
+        for date_format in DATETIME_FORMATS:
+            try:
+                return datetime.strptime(text, date_format)
+            except ValueError:
+                continue
+        raise ValueError(f"некорректная дата: {value!r}")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def parse_transaction_row(row: dict, user_oid, imported_at: datetime, known_categories=()) -> dict:
+    """
+    Проверяет строку выписки и собирает документ транзакции. Категория из выписки
+    сохраняется, только если она из known_categories (она становится именем поля
+    в агрегатах расходов); иначе транзакция категоризуется по описанию.
+    """
+    if isinstance(row, ValueError):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError("строка должна быть объектом")
+    description = str(row.get('description') or '').strip()
+    if not description:
+        raise ValueError("не указано описание")
+    if row.get('amount') in (None, ''):
+        raise ValueError("не указана сумма")
+    transaction_type = str(row.get('type') or 'expense').strip().lower()
+    if transaction_type not in TRANSACTION_TYPES:
+        raise ValueError(f"неизвестный тип транзакции: {transaction_type!r}")
+
+    transaction = {
+        "userId": user_oid,
+        "type": transaction_type,
+        "amount": parse_amount(row['amount']),
+        "description": description,
+        "createdAt": parse_created_at(row.get('createdAt') or row.get('date'), imported_at)
+    }
+    category = str(row.get('category') or '').strip()
+    if category in known_categories:
+        transaction["category"] = category
+    return transaction
+
+
+def categorize_batch(transactions: list, categorize) -> None:
+    """Проставляет категории чанку; одинаковые описания (частые в выписках) категоризуются один раз."""
+    categories = {}
+    for transaction in transactions:
+        if "category" in transaction:
+            continue
+        description = transaction["description"]
+        if description not in categories:
+            categories[description] = categorize(description)
+        transaction["category"] = categories[description]
+
+
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        # Поток перестал читаться (не UTF-8, битый JSON-массив, незакрытая кавычка CSV)
+        self.read_error = None
+
+    def add_error(self, row_number: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "error": message})
+
+    def to_dict(self) -> dict:
+        return {
+            "success": self.failed == 0 and self.read_error is None,
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+            "read_error": self.read_error
+        }
+
+
+def read_rows(rows, report: ImportReport):
+    """
+    Строки выписки до первой ошибки чтения потока. Ошибка попадает в report.read_error,
+    а не прерывает импорт: чанки до нее уже записаны, и клиент должен получить отчет.
+    """
+    iterator = iter(rows)
+    read = 0
+    while True:
+        try:
+            row = next(iterator)
+        except StopIteration:
+            return
+        except (ValueError, csv.Error) as e:
+            report.read_error = f"файл не читается после строки {read}: {e}"
+            return
+        read += 1
+        yield row
+
+
+def import_transactions(db, rows, user_oid, categorize, on_inserted=None, known_categories=(),
+                        chunk_size: int = IMPORT_CHUNK_SIZE, max_rows: int = None) -> ImportReport:
+    """
+    Импортирует строки выписки: проверка, категоризация чанками, insert_many(ordered=False).
+    known_categories — категории, которые можно принять из выписки как есть.
+    on_inserted(documents) вызывается для каждого чанка с успешно вставленными документами.
+    Номера строк в отчете считаются с 1 (без заголовка CSV). Ошибка чтения потока
+    останавливает импорт с частичным отчетом (report.read_error).
+    """
+    report = ImportReport()
+    imported_at = datetime.utcnow()
+    chunk, row_numbers = [], []
+
+    def flush():
+        if not chunk:
+            return
+        categorize_batch(chunk, categorize)
+        failed_indexes = set()
+        try:
+            db.transactions.insert_many(chunk, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed_indexes.add(error['index'])
+                report.add_error(row_numbers[error['index']], error.get('errmsg', 'ошибка записи'))
+        inserted = [doc for index, doc in enumerate(chunk) if index not in failed_indexes]
+        report.imported += len(inserted)
+        if on_inserted and inserted:
+            on_inserted(inserted)
+        chunk.clear()
+        row_numbers.clear()
+
+    for row_number, row in enumerate(read_rows(rows, report), start=1):
+        if max_rows is not None and row_number > max_rows:
+            report.add_error(row_number, f"превышен лимит импорта в {max_rows} строк, остальные строки пропущены")
+            break
+        try:
+            chunk.append(parse_transaction_row(row, user_oid, imported_at, known_categories))
+            row_numbers.append(row_number)
+        except ValueError as e:
+            report.add_error(row_number, str(e))
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+    return report
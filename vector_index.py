@@ -0,0 +1,534 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from ann_index import DEFAULT_PROBES, build_ivf, load_ivf, save_ivf
+from embeddings import embedding_dimensions
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from quantization import QUANTIZED_DTYPES, QuantizedMatrix, quantize
+
+STORE_FORMAT_VERSION = 1
+DEFAULT_RERANK = 20
+
+
+def normalize_rows(matrix):
+    """Приводит строки матрицы к единичной длине (нулевые строки не трогает)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def store_paths(base_path):
+    """Пути к сайдкару и к матрице старого формата (новые сборки пишут файлы build_paths)."""
+    root, _ = os.path.splitext(base_path)
+    return root + ".npy", root + ".meta.json"
+
+
+def build_paths(base_path, build):
+    """
+    Файлы одной сборки хранилища: <база>.<build>.npy, .ivf.npz и квантованные копии.
+    Каждая сборка пишет новые имена, а сайдкар, заменяемый последним одним os.replace,
+    переключает читателей на все файлы сборки сразу.
+    """
+    root, _ = os.path.splitext(base_path)
+    prefix = f"{root}.{build}"
+    paths = {"matrix": prefix + ".npy", "ann": prefix + ".ivf.npz"}
+    for dtype in QUANTIZED_DTYPES:
+        paths[dtype] = prefix + f".{dtype}.npy"
+        paths[dtype + "_scale"] = prefix + f".{dtype}.scale.npy"
+    return paths
+
+
+def new_build_id():
+    return uuid.uuid4().hex[:12]
+
+
+def _store_files(base_path, metadata):
+    """Имена файлов, на которые ссылается сайдкар (у старого формата матрица — <база>.npy)."""
+    if not metadata:
+        return set()
+    files = {metadata.get("matrix_file") or os.path.basename(store_paths(base_path)[0])}
+    files.add((metadata.get("ann") or {}).get("file"))
+    quantized = metadata.get("quantized") or {}
+    files.update((quantized.get("file"), quantized.get("scale_file")))
+    files.discard(None)
+    return files
+
+
+def _read_metadata(meta_path):
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def store_artifacts(base_path):
+    """Все файлы матриц и индексов хранилища на диске: версионированные сборки и старый формат."""
+    directory = os.path.dirname(os.path.abspath(base_path))
+    name = os.path.basename(os.path.splitext(base_path)[0])
+    dtypes = "|".join(re.escape(dtype) for dtype in QUANTIZED_DTYPES)
+    pattern = re.compile(
+        rf"^{re.escape(name)}\.(?:[0-9a-f]{{12}}\.)?(?:npy|ivf\.npz|(?:{dtypes})\.npy|(?:{dtypes})\.scale\.npy)$"
+    )
+    return [os.path.join(directory, entry) for entry in os.listdir(directory) if pattern.match(entry)]
+
+
+def atomic_write(path, write_fn, mode):
+    """Пишет файл через временный файл и os.replace, чтобы читатели не видели полузаписанных данных."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, mode, **({} if 'b' in mode else {"encoding": "utf-8"})) as f:
+        write_fn(f)
+    os.replace(tmp_path, path)
+
+
+def save_vector_store(base_path, vectors, records, ann=None, ann_lists=None, dtype="float32", embedding=None):
+    """
+    Сохраняет векторную базу в компактном бинарном формате.
+    records — словари с content/source (и, опционально, hash) без векторов.
+    Матрица пишется уже нормированной, чтобы при загрузке через mmap
+    ее можно было использовать без копирования.
+    ann="ivf" дополнительно строит IVF-индекс (ann_index.py): строки матрицы и записи
+    переупорядочиваются по спискам, центроиды пишутся в <база>.<build>.ivf.npz.
+    dtype="float16"/"int8" дополнительно сохраняет квантованную копию матрицы —
+    ее main.py загружает по умолчанию; float32-матрица остается для переранжирования.
+    embedding — настройки модели (embeddings.embedding_settings), записываются в метаданные.
+    """
+    matrix = np.ascontiguousarray(normalize_rows(vectors), dtype=np.float32)
+    if matrix.ndim != 2 or len(matrix) != len(records):
+        raise ValueError("Количество векторов и записей должно совпадать")
+    if ann not in (None, "none", "ivf"):
+        raise ValueError(f"Неизвестный тип ANN-индекса: {ann}")
+    if dtype != "float32" and dtype not in QUANTIZED_DTYPES:
+        raise ValueError(f"Неизвестный тип хранения векторов: {dtype}")
+    if embedding and embedding_dimensions(embedding) not in (None, matrix.shape[1]):
+        raise ValueError(f"Размерность векторов {matrix.shape[1]} не совпадает с моделью {embedding}")
+
+    _, meta_path = store_paths(base_path)
+    paths = build_paths(base_path, new_build_id())
+    ann_metadata = None
+    if ann == "ivf" and len(matrix):
+        order, centroids, offsets = build_ivf(matrix, ann_lists)
+        matrix = np.ascontiguousarray(matrix[order])
+        records = [records[i] for i in order]
+        ann_metadata = {"type": "ivf", "lists": int(len(centroids)), "file": os.path.basename(paths["ann"])}
+
+    metadata = {
+        "version": STORE_FORMAT_VERSION,
+        "count": int(matrix.shape[0]),
+        "dimensions": int(matrix.shape[1]),
+        "dtype": "float32",
+        "normalized": True,
+        "matrix_file": os.path.basename(paths["matrix"]),
+        "embedding": {"model": embedding["model"], "dimensions": int(matrix.shape[1])} if embedding else None,
+        "ann": ann_metadata,
+        "quantized": None,
+        "records": [{k: v for k, v in record.items() if k != "vector"} for record in records],
+    }
+
+    # Сначала файлы сборки, затем сайдкар: до его замены читатели видят только прежнюю сборку
+    written = [paths["matrix"]]
+    atomic_write(paths["matrix"], lambda f: np.save(f, matrix), "wb")
+    if ann_metadata:
+        written.append(paths["ann"])
+        atomic_write(paths["ann"], lambda f: save_ivf(f, centroids, offsets), "wb")
+    if dtype in QUANTIZED_DTYPES:
+        quantized = quantize(matrix, dtype)
+        atomic_write(paths[dtype], lambda f: np.save(f, quantized.data), "wb")
+        written.append(paths[dtype])
+        metadata["quantized"] = {"dtype": dtype, "file": os.path.basename(paths[dtype])}
+        if quantized.scales is not None:
+            atomic_write(paths[dtype + "_scale"], lambda f: np.save(f, quantized.scales), "wb")
+            written.append(paths[dtype + "_scale"])
+            metadata["quantized"]["scale_file"] = os.path.basename(paths[dtype + "_scale"])
+    previous_files = _store_files(base_path, _read_metadata(meta_path))
+    atomic_write(meta_path, lambda f: json.dump(metadata, f, ensure_ascii=False), "w")
+    written.append(meta_path)
+
+    # Предыдущая сборка остается: воркер мог прочитать старый сайдкар и еще не открыть ее файлы.
+    # Более старые сборки и файлы старого формата удаляются
+    keep = _store_files(base_path, metadata) | previous_files
+    for path in store_artifacts(base_path):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+    return written
+
+
+def load_vector_records(base_path, mmap=True):
+    """Читает бинарное хранилище: возвращает (матрица, метаданные)."""
+    legacy_matrix_path, meta_path = store_paths(base_path)
+    with open(meta_path, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    if metadata.get("version") != STORE_FORMAT_VERSION:
+        raise ValueError(f"Неподдерживаемая версия хранилища {meta_path}: {metadata.get('version')}")
+
+    matrix_path = store_file(base_path, metadata.get("matrix_file")) or legacy_matrix_path
+    matrix = np.load(matrix_path, mmap_mode='r' if mmap else None)
+    if matrix.shape != (metadata["count"], metadata["dimensions"]):
+        raise ValueError(f"Размер матрицы {matrix_path} не совпадает с метаданными")
+    return matrix, metadata
+
+
+def store_file(base_path, name):
+    """Полный путь к файлу, на который ссылается сайдкар (None, если ссылки нет)."""
+    return os.path.join(os.path.dirname(base_path), name) if name else None
+
+
+def check_embedding(base_path, model, dimensions, embedding):
+    """
+    Отказывает в загрузке индекса из другого векторного пространства, чем запросы:
+    сравниваются модель (если она записана в метаданных) и размерность.
+    """
+    expected = embedding_dimensions(embedding)
+    if (model is not None and model != embedding["model"]) or (expected is not None and dimensions != expected):
+        raise ValueError(
+            f"Индекс {base_path} построен {f'моделью {model}' if model else 'неизвестной моделью'} ({dimensions} измерений), "
+            f"а запросы векторизуются {embedding['model']} ({expected} измерений). "
+            f"Пересоберите базу prepare_data.py или исправьте EMBEDDING_MODEL/EMBEDDING_DIMENSIONS"
+        )
+
+
+def load_ann_backend(base_path, metadata, n_probe=None):
+    """
+    IVF-индекс хранилища, если он был построен. При несоответствии матрице
+    поиск остается точным — индекс не должен ломать загрузку базы.
+    """
+    ann = metadata.get("ann")
+    if not ann:
+        return None
+    if ann.get("type") != "ivf":
+        print(f"⚠ Неизвестный ANN-индекс {ann.get('type')} в {base_path}, используется точный поиск")
+        return None
+    if n_probe is None:
+        n_probe = int(os.getenv("VECTOR_ANN_PROBES", DEFAULT_PROBES))
+    try:
+        return load_ivf(store_file(base_path, ann["file"]), metadata["count"], metadata["dimensions"], n_probe)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠ ANN-индекс {base_path} не загружен, используется точный поиск: {e}")
+        return None
+
+
+def load_quantized_matrix(base_path, matrix, metadata, dtype, mmap=True):
+    """
+    Квантованная матрица: готовая копия из prepare_data.py (mmap), если ее тип совпадает,
+    иначе квантуется из float32 при загрузке (отдельная копия в памяти воркера).
+    """
+    stored = metadata.get("quantized") or {}
+    if stored.get("dtype") == dtype:
+        data = np.load(store_file(base_path, stored["file"]), mmap_mode='r' if mmap else None)
+        scales = np.load(store_file(base_path, stored["scale_file"])) if stored.get("scale_file") else None
+        if data.shape != matrix.shape or (scales is not None and len(scales) != len(matrix)):
+            raise ValueError(f"Квантованная матрица {stored['file']} не совпадает с метаданными")
+        return QuantizedMatrix(data, scales)
+    print(f"🗜️  {os.path.basename(base_path)}: квантование {len(matrix)} векторов в {dtype} при загрузке")
+    return quantize(matrix, dtype)
+
+
+def load_vector_store(base_path, mmap=True, dtype=None, rerank=DEFAULT_RERANK, embedding=None):
+    """
+    Загружает бинарное хранилище; матрица отображается в память (mmap_mode='r').
+    dtype — тип матрицы для поиска (по умолчанию тот, что выбран при сборке);
+    для float16/int8 top-`rerank` кандидатов переранжируются по float32-матрице,
+    из которой через mmap читаются только строки кандидатов.
+    embedding — настройки модели запросов; индекс другой модели/размерности не загружается.
+    """
+    matrix, metadata = load_vector_records(base_path, mmap)
+    if embedding and metadata["count"]:
+        stored_model = (metadata.get("embedding") or {}).get("model")
+        check_embedding(base_path, stored_model, metadata["dimensions"], embedding)
+    records = metadata["records"]
+    dtype = dtype or (metadata.get("quantized") or {}).get("dtype", "float32")
+    if dtype != "float32" and dtype not in QUANTIZED_DTYPES:
+        raise ValueError(f"Неизвестный тип хранения векторов: {dtype}")
+
+    quantized = dtype in QUANTIZED_DTYPES
+    return VectorIndex(
+        load_quantized_matrix(base_path, matrix, metadata, dtype, mmap) if quantized else matrix,
+        [r["content"] for r in records],
+        [r["source"] for r in records],
+        normalized=metadata.get("normalized", False),
+        ann=load_ann_backend(base_path, metadata),
+        rerank_matrix=matrix if quantized and rerank else None,
+        rerank=rerank,
+    )
+
+
+def read_store_metadata(base_path):
+    """Содержимое сайдкара хранилища; {} если его нет или он не читается."""
+    return _read_metadata(store_paths(base_path)[1])
+
+
+def has_vector_store(base_path):
+    """Хранилище существует, если есть сайдкар: он пишется последним и ссылается на файлы сборки."""
+    return os.path.exists(store_paths(base_path)[1])
+
+
+def remove_vector_store(base_path):
+    """
+    Удаляет бинарное хранилище (например, после записи только JSON), чтобы
+    load_vector_index не продолжал отдавать старую матрицу вместо нового JSON.
+    Сайдкар удаляется первым — без него хранилище уже не считается существующим.
+    """
+    meta_path = store_paths(base_path)[1]
+    removed = []
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+        removed.append(meta_path)
+    for path in store_artifacts(base_path):
+        os.remove(path)
+        removed.append(path)
+    return removed
+
+
+class VectorIndex:
+    """
+    Векторный индекс базы знаний одного языка:
+    непрерывная float32-матрица с заранее нормированными строками
+    и параллельные массивы content/source.
+    ann — необязательный приближенный бэкенд (IVFBackend) поверх той же матрицы.
+    vectors может быть QuantizedMatrix (float16/int8); тогда rerank_matrix — исходная
+    float32-матрица для переранжирования top-`rerank` кандидатов.
+    """
+
+    def __init__(self, vectors, contents, sources, normalized=False, ann=None, rerank_matrix=None, rerank=0):
+        if isinstance(vectors, QuantizedMatrix):
+            # Квантованная матрица хранится как есть (нормирована при сборке)
+            matrix = vectors
+        else:
+            matrix = np.asarray(vectors, dtype=np.float32)
+            if matrix.size == 0:
+                matrix = matrix.reshape(0, matrix.shape[-1] if matrix.ndim == 2 else 0)
+            if matrix.ndim != 2:
+                raise ValueError(f"Ожидается двумерная матрица векторов, получено измерений: {matrix.ndim}")
+            if not normalized:
+                matrix = normalize_rows(matrix)
+            # Для уже нормированной (в т.ч. memory-mapped) матрицы копия не создается
+            matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        if not (len(matrix) == len(contents) == len(sources)):
+            raise ValueError("Количество векторов, content и source должно совпадать")
+        if rerank_matrix is not None and rerank_matrix.shape != matrix.shape:
+            raise ValueError("Матрица для переранжирования не совпадает с основной")
+
+        self.matrix = matrix
+        self.contents = list(contents)
+        self.sources = list(sources)
+        self.ann = ann
+        self.rerank_matrix = rerank_matrix
+        self.rerank = rerank if rerank_matrix is not None else 0
+        # Лексический индекс строится вместе с векторным — для гибридного и деградированного поиска
+        self.lexical = BM25Index(self.contents)
+
+    @classmethod
+    def from_records(cls, records):
+        """Строит индекс из списка словарей формата vector_database.json."""
+        return cls(
+            [item['vector'] for item in records],
+            [item['content'] for item in records],
+            [item['source'] for item in records],
+        )
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 0), dtype=np.float32), [], [])
+
+    @property
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    @property
+    def dtype(self):
+        return str(self.matrix.dtype)
+
+    def __len__(self):
+        return len(self.contents)
+
+    def _unit_query(self, query_vector):
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        if len(self) and len(query) != self.dimensions:
+            raise ValueError(f"Размерность запроса {len(query)} не совпадает с индексом ({self.dimensions})")
+        norm = np.linalg.norm(query)
+        return query / norm if norm > 0 else None
+
+    def scores(self, query_vector):
+        """Косинусная близость запроса ко всем чанкам одним матрично-векторным произведением."""
+        query = self._unit_query(query_vector)
+        if query is None:
+            return np.zeros(len(self), dtype=np.float32)
+        return self.matrix @ query
+
+    def top_k_indices(self, query_vector, top_k=2):
+        """
+        Индексы top_k ближайших чанков по убыванию близости: через ANN-бэкенд, если он есть,
+        и с float32-переранжированием кандидатов для квантованной матрицы.
+        """
+        if len(self) == 0 or top_k <= 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.float32)
+        query = self._unit_query(query_vector)
+        if query is None or self.rerank_matrix is None:
+            return self._candidate_indices(query_vector, query, top_k)
+
+        order, _ = self._candidate_indices(query_vector, query, min(max(top_k, self.rerank), len(self)))
+        # Строки читаются по возрастанию индекса — последовательнее для mmap
+        rows = np.sort(order)
+        sims = np.asarray(self.rerank_matrix[rows], dtype=np.float32) @ query
+        best = np.argsort(-sims, kind='stable')[:top_k]
+        return rows[best], sims[best]
+
+    def _candidate_indices(self, query_vector, query, top_k):
+        if self.ann is not None and query is not None and top_k <= len(self):
+            order, sims = self.ann.top_k_indices(self.matrix, query, top_k)
+            # В проверенных списках может оказаться меньше top_k векторов
+            if len(order) == top_k:
+                return order, sims
+        return self.exact_top_k_indices(query_vector, top_k)
+
+    def exact_top_k_indices(self, query_vector, top_k=2):
+        """Точный поиск: близость ко всем чанкам и частичная сортировка."""
+        if len(self) == 0 or top_k <= 0:
+            return np.array([], dtype=np.intp), np.array([], dtype=np.float32)
+
+        sims = self.scores(query_vector)
+        top_k = min(top_k, len(sims))
+        if top_k < len(sims):
+            candidates = np.argpartition(-sims, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(sims))
+        order = candidates[np.argsort(-sims[candidates], kind='stable')]
+        return order, sims[order]
+
+    def _chunks(self, indices):
+        return [(self.contents[i], self.sources[i]) for i in indices]
+
+    def search(self, query_vector, top_k=2):
+        """Возвращает [(content, source), ...] для top_k ближайших чанков."""
+        indices, _ = self.top_k_indices(query_vector, top_k)
+        return self._chunks(indices)
+
+    def lexical_search(self, text, top_k=2):
+        """Только BM25 — когда эмбеддинг вопроса недоступен."""
+        indices, _ = self.lexical.top_k_indices(text, top_k)
+        return self._chunks(indices)
+
+    def hybrid_search(self, query_vector, text, top_k=2, candidates=20, rrf_k=60):
+        """Векторный и BM25-кандидаты, слитые через reciprocal rank fusion."""
+        vector_ranking, _ = self.top_k_indices(query_vector, candidates)
+        lexical_ranking, _ = self.lexical.top_k_indices(text, candidates)
+        return self._chunks(reciprocal_rank_fusion([vector_ranking, lexical_ranking], k=rrf_k)[:top_k])
+
+
+def load_vector_index(base_path, dtype=None, rerank=DEFAULT_RERANK, embedding=None):
+    """
+    Загружает индекс: бинарное хранилище (mmap), если оно есть, иначе JSON.
+    dtype/rerank применяются только к бинарному хранилищу; для JSON, где модель
+    не записана, с настройками embedding сверяется только размерность.
+    """
+    if has_vector_store(base_path):
+        return load_vector_store(base_path, mmap=True, dtype=dtype, rerank=rerank, embedding=embedding)
+    with open(base_path, "r", encoding="utf-8") as f:
+        index = VectorIndex.from_records(json.load(f))
+    if embedding and len(index):
+        check_embedding(base_path, None, index.dimensions, embedding)
+    return index
+
+
+def file_version(base_path):
+    """
+    Штамп версии файлов индекса (mtime/размер). Для бинарного хранилища берется
+    сайдкар — он пишется последним, поэтому его смена означает завершенную запись.
+    """
+    path = store_paths(base_path)[1] if has_vector_store(base_path) else base_path
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return f"{os.path.basename(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+
+class VectorIndexManager:
+    """
+    Держит загруженные индексы по языкам и подменяет их без перезапуска воркеров.
+    Фоновый поток следит за штампами файлов; новый индекс строится целиком
+    и затем атомарно подставляется вместо старого.
+    """
+
+    def __init__(self, paths, poll_interval=30, loader=load_vector_index):
+        self.paths = dict(paths)
+        self.poll_interval = poll_interval
+        self.loader = loader
+        self._indexes = {lang: VectorIndex.empty() for lang in self.paths}
+        self._versions = {lang: None for lang in self.paths}
+        self._loaded_at = {lang: None for lang in self.paths}
+        self._failed_versions = {lang: None for lang in self.paths}
+        self._lock = threading.Lock()
+        self._watcher_lock = threading.Lock()
+        self._watcher_pid = None
+
+    def get(self, lang):
+        self._ensure_watcher()
+        return self._indexes[lang]
+
+    def reload(self, lang, force=False):
+        """Перезагружает индекс языка, если изменился штамп файла. Возвращает True при подмене."""
+        path = self.paths[lang]
+        with self._lock:
+            version = file_version(path)
+            if version is None:
+                print(f"⚠ ПРЕДУПРЕЖДЕНИЕ: Файл {path} ({lang.upper()}) не найден.")
+                print("  Запустите prepare_data.py для создания базы знаний.")
+                return False
+            if not force and version in (self._versions[lang], self._failed_versions[lang]):
+                return False
+            try:
+                index = self.loader(path)
+            except Exception as e:
+                self._failed_versions[lang] = version
+                print(f"❌ Не удалось загрузить индекс {path}, остается версия {self._versions[lang]}: {e}")
+                return False
+            self._indexes[lang] = index
+            self._versions[lang] = version
+            self._loaded_at[lang] = time.time()
+        print(f"✓ База знаний '{lang}' загружена ({version}). Записей: {len(index)}")
+        return True
+
+    def reload_all(self, force=False):
+        return {lang: self.reload(lang, force) for lang in self.paths}
+
+    def status(self):
+        return {
+            lang: {
+                "path": self.paths[lang],
+                "version": self._versions[lang],
+                "loaded_at": self._loaded_at[lang],
+                "records": len(self._indexes[lang]),
+                "dimensions": self._indexes[lang].dimensions,
+                "dtype": self._indexes[lang].dtype,
+                "rerank": self._indexes[lang].rerank,
+                "ann": self._indexes[lang].ann.status() if self._indexes[lang].ann else None,
+            }
+            for lang in self.paths
+        }
+
+    def _ensure_watcher(self):
+        # Свой поток в каждом процессе, как у LazyClient
+        if self.poll_interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        with self._watcher_lock:
+            # Повторная проверка под блокировкой: первые запросы могут прийти одновременно
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+            threading.Thread(target=self._watch, name="vector-index-watcher", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.reload_all()
+            except Exception as e:
+                print(f"❌ Ошибка при проверке обновлений индекса: {e}")